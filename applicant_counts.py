@@ -0,0 +1,69 @@
+"""Verify and repair the denormalised applicant counts.
+
+``job_applicant_counts`` (migration 25) holds the number of applications of
+every job and is kept current by triggers on ``job`` and
+``job_application``. Anything that bypasses them, such as
+``session_replication_role = replica`` or a restore of one table, can leave
+it out of step; ``verify`` lists such jobs and ``repair`` recounts them.
+
+Usage:
+    python applicant_counts.py verify
+    python applicant_counts.py repair
+"""
+import argparse
+import sys
+
+from sqlalchemy import text
+
+_DRIFT = """
+    SELECT j.job_id, c.applicants AS stored, coalesce(a.applicants, 0) AS actual
+    FROM job j
+    LEFT JOIN job_applicant_counts c ON c.job_id = j.job_id
+    LEFT JOIN (SELECT job_id, count(*) AS applicants FROM job_application GROUP BY job_id) a
+        ON a.job_id = j.job_id
+    WHERE c.applicants IS DISTINCT FROM coalesce(a.applicants, 0)
+"""
+
+_REPAIR = text(f"""
+    INSERT INTO job_applicant_counts (job_id, applicants)
+    SELECT job_id, actual FROM ({_DRIFT}) drift
+    ORDER BY job_id
+    ON CONFLICT (job_id) DO UPDATE SET applicants = EXCLUDED.applicants
+""")
+
+
+def drift(connection):
+    """``(job_id, stored, actual)`` for every job whose count is wrong."""
+    return connection.execute(text(_DRIFT + ' ORDER BY j.job_id')).all()
+
+
+def repair(connection):
+    """Recount the jobs that drifted. Returns how many were fixed."""
+    # SHARE mode lets readers through but holds off new applications, which
+    # could otherwise change a count between reading and writing it.
+    connection.execute(text('LOCK TABLE job_application IN SHARE MODE'))
+    return connection.execute(_REPAIR).rowcount
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Verify or repair job_applicant_counts.')
+    parser.add_argument('command', choices=('verify', 'repair'))
+    args = parser.parse_args(argv)
+
+    from migrations import get_engine
+    engine = get_engine()
+    if args.command == 'repair':
+        with engine.begin() as connection:
+            fixed = repair(connection)
+        print(f'{fixed} job counts repaired')
+        return 0
+    with engine.connect() as connection:
+        rows = drift(connection)
+    for row in rows[:20]:
+        print(f'job {row.job_id}: stored {row.stored}, actual {row.actual}')
+    print(f'{len(rows)} job counts out of step')
+    return 1 if rows else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,319 @@
+"""Route benchmark: latency percentiles, throughput, query counts and CPU.
+
+Drives every page of the app either in-process through the Flask test
+client (default; also counts the SQL statements each request issues and
+the CPU time the app spends on each, database driver included) or over
+HTTP against a running server. Results are written as JSON so runs can
+be compared over time.
+
+Usage:
+    python synthetic_data.py --scale 1m --truncate
+    python benchmark.py --requests 200 --output bench.json
+    python benchmark.py --url http://127.0.0.1:8000 --concurrency 16 --output bench-http.json
+    python benchmark.py --compare bench-before.json --output bench-after.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from sqlalchemy import event, text
+
+SERVER_TIMING_QUERIES = re.compile(r'db;[^,]*desc="(\d+) quer')
+
+
+class Route:
+    def __init__(self, name, path, method='GET', data=None, write=False, headers=None):
+        self.name = name
+        self.path = path
+        self.method = method
+        self.data = data
+        self.write = write
+        self.headers = headers or {}
+
+
+def build_routes(samples):
+    """Routes to exercise, with IDs filled in from ``samples``."""
+    user = samples['user_id'][0]
+    caregiver = samples['caregiver_user_id'][0]
+    member = samples['member_user_id'][0]
+    job = samples['job_id'][0]
+    appointment = samples['appointment_id'][0]
+    prefix = samples['name_prefix']
+    routes = [
+        Route('index', '/'),
+        Route('users', '/users'),
+        Route('caregivers', '/caregivers'),
+        Route('members', '/members'),
+        Route('addresses', '/addresses'),
+        Route('jobs', '/jobs'),
+        Route('jobs_by_id', '/jobs?sort=id&order=asc'),
+        Route('jobs_by_applicants', '/jobs?sort=applicants&order=desc&min_applicants=2'),
+        Route('applications', '/applications'),
+        Route('applications_by_job', f'/applications?job_id={job}'),
+        Route('appointments', '/appointments'),
+        Route('appointments_by_id', '/appointments?sort=id&order=desc&per_page=200'),
+        Route('add_caregiver_form', '/caregivers/add'),
+        Route('edit_caregiver_form', f'/caregivers/edit/{caregiver}'),
+        Route('edit_user_form', f'/users/edit/{user}'),
+        Route('edit_member_form', f'/members/edit/{member}'),
+        Route('edit_address_form', f'/addresses/edit/{member}'),
+        Route('add_job_form', '/jobs/add'),
+        Route('edit_job_form', f'/jobs/edit/{job}'),
+        Route('add_application_form', '/applications/add'),
+        Route('add_appointment_form', '/appointments/add'),
+        Route('edit_appointment_form', f'/appointments/edit/{appointment}'),
+        Route('search_users', f'/api/search/users?q={prefix}'),
+        Route('search_members', f'/api/search/members?q={prefix}'),
+        Route('search_caregivers', f'/api/search/caregivers?q={prefix}'),
+        Route('search_jobs', f'/api/search/jobs?q={prefix}'),
+        Route('caregiver_search', '/api/caregivers/search'),
+        Route('caregiver_search_filtered',
+              '/api/caregivers/search?type=babysitter&city=Almaty&city=Astana&min_rate=8.5&max_rate=12.25'),
+        Route('caregiver_availability',
+              '/api/caregivers/available?start=2025-06-07T09:00&end=2025-06-07T12:00&type=babysitter&city=Astana'),
+        Route('job_text_search', '/api/jobs/search?q=first+aid'),
+        Route('member_text_search', '/api/members/search?q=pets'),
+        Route('caregiver_profile_search', '/api/caregivers/profiles/search?q=nurse'),
+        Route('job_candidates', f'/api/jobs/{job}/candidates'),
+        Route('caregiver_calendar', f'/api/caregivers/{caregiver}/calendar?view=month'),
+        Route('member_calendar_ics', f'/members/{member}/calendar.ics'),
+        Route('api_jobs', '/api/v1/jobs?sort=date&order=desc'),
+        Route('api_appointments_by_caregiver', f'/api/v1/appointments?caregiver_user_id={caregiver}'),
+        # Answered 304 from the table version alone.
+        Route('api_jobs_not_modified', '/api/v1/jobs?sort=date&order=desc',
+              headers={'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'}),
+        Route('reports', '/reports'),
+        Route('report_above_average', '/api/reports/above-average'),
+        Route('pool_metrics', '/metrics/pool'),
+    ]
+    routes.append(Route('edit_appointment', f'/appointments/edit/{appointment}', 'POST',
+                        samples['appointment_form'], write=True))
+    routes.append(Route('add_job', '/jobs/add', 'POST', {
+        'member_user_id': member, 'required_caregiving_type': 'babysitter',
+        'other_requirements': 'benchmark', 'date_posted': '2025-01-01',
+    }, write=True))
+    return routes
+
+
+def collect_samples(engine):
+    with engine.connect() as connection:
+        def ids(sql):
+            return [row[0] for row in connection.execute(text(sql))]
+        samples = {
+            'user_id': ids('SELECT user_id FROM "USER" ORDER BY user_id LIMIT 20'),
+            'caregiver_user_id': ids('SELECT caregiver_user_id FROM caregiver ORDER BY 1 LIMIT 20'),
+            'member_user_id': ids('SELECT member_user_id FROM address ORDER BY 1 LIMIT 20'),
+            'job_id': ids('SELECT job_id FROM job ORDER BY 1 LIMIT 20'),
+            'appointment_id': ids('SELECT appointment_id FROM appointment ORDER BY 1 LIMIT 20'),
+        }
+        if not all(samples.values()):
+            raise SystemExit('Every table needs data; run synthetic_data.py first')
+        name = connection.execute(text('SELECT given_name FROM "USER" ORDER BY user_id LIMIT 1')).scalar()
+        samples['name_prefix'] = name[:3].lower()
+        row = connection.execute(text(
+            'SELECT caregiver_user_id, member_user_id, appointment_date, appointment_time, work_hours, status '
+            'FROM appointment WHERE appointment_id = :id'), {'id': samples['appointment_id'][0]}).one()
+        samples['appointment_form'] = {
+            'caregiver_user_id': row[0], 'member_user_id': row[1], 'appointment_date': row[2].isoformat(),
+            'appointment_time': row[3].strftime('%H:%M'), 'work_hours': str(row[4]), 'status': row[5],
+        }
+        counts = {}
+        for table in ('"USER"', 'caregiver', 'member', 'address', 'job', 'job_application', 'appointment'):
+            counts[table.strip('"')] = connection.execute(text(f'SELECT count(*) FROM {table}')).scalar()
+        samples['row_counts'] = counts
+    return samples
+
+
+class InProcessClient:
+    """Flask test client plus a per-thread SQL statement counter."""
+
+    measures_cpu = True
+
+    def __init__(self):
+        from app import app, db
+        self.app = app
+        self.local = threading.local()
+        with app.app_context():
+            self.engine = db.engine
+
+        @event.listens_for(self.engine, 'before_cursor_execute')
+        def count(conn, cursor, statement, parameters, context, executemany):
+            self.local.queries = getattr(self.local, 'queries', 0) + 1
+
+    def request(self, route):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        self.local.queries = 0
+        started = time.perf_counter()
+        response = client.open(route.path, method=route.method, data=route.data, headers=route.headers)
+        elapsed = time.perf_counter() - started
+        return response.status_code, elapsed, self.local.queries
+
+
+class HttpClient:
+    measures_cpu = False
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, route):
+        data = None
+        if route.data is not None:
+            data = urllib.parse.urlencode(route.data).encode()
+        req = urllib.request.Request(self.base_url + route.path, data=data, headers=route.headers, method=route.method)
+        started = time.perf_counter()
+        try:
+            with _NoRedirect.open(req, timeout=60) as response:
+                response.read()
+                status, headers = response.status, response.headers
+        except urllib.error.HTTPError as e:
+            status, headers = e.code, e.headers
+        elapsed = time.perf_counter() - started
+        match = SERVER_TIMING_QUERIES.search(headers.get('Server-Timing', '') or '')
+        return status, elapsed, int(match.group(1)) if match else None
+
+
+class _NoRedirectHandler(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+_NoRedirect = urllib.request.build_opener(_NoRedirectHandler)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    # Nearest-rank percentile.
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def run_route(client, route, requests, concurrency, warmup):
+    for _ in range(warmup):
+        client.request(route)
+    results = []
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(lambda _: client.request(route), range(requests)))
+    else:
+        results = [client.request(route) for _ in range(requests)]
+    wall = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    latencies = sorted(elapsed * 1000 for _, elapsed, _ in results)
+    errors = sum(1 for status, _, _ in results if status >= 400)
+    queries = [q for _, _, q in results if q is not None]
+    return {
+        'method': route.method,
+        'path': route.path,
+        'requests': len(results),
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'max_ms': round(latencies[-1], 3),
+        'throughput_rps': round(len(results) / wall, 1) if wall else None,
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+        'cpu_ms_per_request': round(cpu / len(results) * 1000, 3) if client.measures_cpu else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _change(before, after):
+    return f'{(after - before) / before * 100:>+7.1f}%' if before and after is not None else f'{"":>8}'
+
+
+def compare(previous, current):
+    print(f'{"route":28} {"p95 before":>11} {"p95 after":>10} {"change":>8} {"rps before":>11} {"rps after":>10} '
+          f'{"cpu before":>11} {"cpu after":>10} {"change":>8}')
+    for name, after in current['routes'].items():
+        before = previous['routes'].get(name)
+        if not before:
+            continue
+        cpu_before, cpu_after = before.get('cpu_ms_per_request'), after.get('cpu_ms_per_request')
+        print(f'{name:28} {before["p95_ms"]:>11.2f} {after["p95_ms"]:>10.2f} '
+              f'{_change(before["p95_ms"], after["p95_ms"])} '
+              f'{before["throughput_rps"] or 0:>11.1f} {after["throughput_rps"] or 0:>10.1f} '
+              f'{cpu_before if cpu_before is not None else "-":>11} {cpu_after if cpu_after is not None else "-":>10} '
+              f'{_change(cpu_before, cpu_after)}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark every route of the app.')
+    parser.add_argument('--url', help='benchmark a running server over HTTP instead of in-process')
+    parser.add_argument('--requests', type=int, default=100, help='measured requests per route')
+    parser.add_argument('--warmup', type=int, default=5, help='unmeasured requests per route')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--routes', help='comma-separated route names to run (default: all)')
+    parser.add_argument('--include-writes', action='store_true', help='also run POST routes (adds jobs)')
+    parser.add_argument('--output', help='write the JSON report here (default: stdout)')
+    parser.add_argument('--compare', help='previous JSON report to compare against')
+    args = parser.parse_args(argv)
+
+    from migrations import get_engine
+    samples = collect_samples(get_engine())
+    routes = [r for r in build_routes(samples) if args.include_writes or not r.write]
+    if args.routes:
+        wanted = set(args.routes.split(','))
+        routes = [r for r in routes if r.name in wanted]
+    client = HttpClient(args.url) if args.url else InProcessClient()
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'mode': 'http' if args.url else 'in-process',
+            'url': args.url,
+            'requests_per_route': args.requests,
+            'concurrency': args.concurrency,
+            'row_counts': samples['row_counts'],
+        },
+        'routes': {},
+    }
+    for route in routes:
+        result = run_route(client, route, args.requests, args.concurrency, args.warmup)
+        report['routes'][route.name] = result
+        print(f'{route.name:28} p50 {result["p50_ms"]:8.2f}ms  p95 {result["p95_ms"]:8.2f}ms  '
+              f'p99 {result["p99_ms"]:8.2f}ms  {result["throughput_rps"]:8.1f} req/s  '
+              f'queries {result["queries_per_request"]}  cpu {result["cpu_ms_per_request"]}ms', file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
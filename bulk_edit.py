@@ -0,0 +1,276 @@
+"""Set-based bulk edits: rate adjustments, status changes and deletes.
+
+Each edit is one UPDATE or DELETE over the rows matching a set of filters,
+run in a single transaction. The matched rows are locked in primary-key
+order first, so two bulk edits, or a bulk edit and single-row edits from
+the app, queue behind each other instead of deadlocking. A dry run counts
+the matching rows and shows a sample of what would change, without
+writing.
+
+Targets, their filters and their actions:
+
+    caregivers    id type gender city min_rate max_rate
+                  rate: percent=10 | amount=0.5 | commission=true
+    appointments  id caregiver_user_id member_user_id status since before
+                  status: status=declined; delete
+    jobs          id member_user_id type posted_since posted_before
+                  delete
+    applications  job_id caregiver_user_id applied_since applied_before
+                  delete
+
+``commission`` is the queries.py 3.2 rule: $0.30 on rates under $10 and 10%
+on the rest. It is a single CASE, so a rate that crosses $10 with the $0.30
+is not charged the 10% as well. An edit with no filters is refused unless
+``all=true`` is given.
+
+Usage:
+    python bulk_edit.py appointments status --set status=declined status=pending before=2025-06-01 --dry-run
+    python bulk_edit.py caregivers rate --set percent=10 type="elderly care"
+    python bulk_edit.py jobs delete posted_before=2024-01-01
+"""
+import argparse
+import json
+import sys
+import time
+from datetime import date
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+import scheduling
+
+SAMPLE_ROWS = 10
+APPOINTMENT_STATUSES = ('accepted', 'pending', 'declined')
+
+
+class BulkEditError(Exception):
+    pass
+
+
+def _parse(kind, name, value):
+    try:
+        if kind is int:
+            return int(value)
+        if kind is date:
+            return value if isinstance(value, date) else date.fromisoformat(str(value))
+        if kind is Decimal:
+            number = Decimal(str(value))
+            if not number.is_finite():
+                raise ValueError(value)
+            return number
+        if kind is bool:
+            return value if isinstance(value, bool) else str(value).lower() in ('1', 'true', 'yes')
+        return str(value)
+    except (ValueError, TypeError, InvalidOperation):
+        raise BulkEditError(f'{name} must be a valid {kind.__name__}, not {value!r}')
+
+
+class Filter:
+    """A WHERE condition on ``:name``. ``many`` filters take a list of values."""
+
+    def __init__(self, condition, kind=str, many=False):
+        self.condition = condition
+        self.kind = kind
+        self.many = many
+
+    def parse(self, name, value):
+        if self.many:
+            values = value if isinstance(value, (list, tuple)) else [value]
+            return [_parse(self.kind, name, v) for v in values]
+        return _parse(self.kind, name, value)
+
+
+class Target:
+    def __init__(self, table, alias, key, filters, actions):
+        self.table = table
+        self.alias = alias
+        self.key = key
+        self.filters = filters
+        self.actions = actions
+
+
+def _rate(target, values):
+    modes = [name for name in ('percent', 'amount', 'commission') if values.get(name) not in (None, False, '')]
+    if len(modes) != 1:
+        raise BulkEditError('set exactly one of percent, amount or commission')
+    mode = modes[0]
+    if mode == 'commission':
+        if not _parse(bool, 'commission', values['commission']):
+            raise BulkEditError('commission must be true')
+        return ('CASE WHEN c.hourly_rate < 10 THEN c.hourly_rate + 0.3 '
+                'ELSE round(c.hourly_rate * 1.1, 2) END'), {}, 'hourly_rate'
+    change = _parse(Decimal, mode, values[mode])
+    if mode == 'percent':
+        if change <= -100:
+            raise BulkEditError('percent must be greater than -100')
+        return 'round(c.hourly_rate * (1 + CAST(:percent AS numeric) / 100), 2)', {'percent': change}, 'hourly_rate'
+    return 'c.hourly_rate + CAST(:amount AS numeric)', {'amount': change}, 'hourly_rate'
+
+
+def _status(target, values):
+    status = values.get('status')
+    if status not in APPOINTMENT_STATUSES:
+        raise BulkEditError(f'status must be one of {", ".join(APPOINTMENT_STATUSES)}')
+    return 'CAST(:new_status AS varchar)', {'new_status': status}, 'status'
+
+
+TARGETS = {
+    'caregivers': Target('caregiver', 'c', ('caregiver_user_id',), {
+        'id': Filter('c.caregiver_user_id = ANY(:id)', int, many=True),
+        'type': Filter('c.caregiving_type = ANY(:type)', many=True),
+        'gender': Filter('c.gender = ANY(:gender)', many=True),
+        'city': Filter('EXISTS (SELECT 1 FROM "USER" u WHERE u.user_id = c.caregiver_user_id '
+                       'AND u.city = ANY(:city))', many=True),
+        'min_rate': Filter('c.hourly_rate >= :min_rate', Decimal),
+        'max_rate': Filter('c.hourly_rate <= :max_rate', Decimal),
+    }, {'rate': _rate}),
+    'appointments': Target('appointment', 'a', ('appointment_id',), {
+        'id': Filter('a.appointment_id = ANY(:id)', int, many=True),
+        'caregiver_user_id': Filter('a.caregiver_user_id = ANY(:caregiver_user_id)', int, many=True),
+        'member_user_id': Filter('a.member_user_id = ANY(:member_user_id)', int, many=True),
+        'status': Filter('a.status = ANY(:status)', many=True),
+        'since': Filter('a.appointment_date >= :since', date),
+        'before': Filter('a.appointment_date < :before', date),
+    }, {'status': _status, 'delete': None}),
+    'jobs': Target('job', 'j', ('job_id',), {
+        'id': Filter('j.job_id = ANY(:id)', int, many=True),
+        'member_user_id': Filter('j.member_user_id = ANY(:member_user_id)', int, many=True),
+        'type': Filter('j.required_caregiving_type = ANY(:type)', many=True),
+        'posted_since': Filter('j.date_posted >= :posted_since', date),
+        'posted_before': Filter('j.date_posted < :posted_before', date),
+    }, {'delete': None}),
+    'applications': Target('job_application', 'ja', ('caregiver_user_id', 'job_id'), {
+        'job_id': Filter('ja.job_id = ANY(:job_id)', int, many=True),
+        'caregiver_user_id': Filter('ja.caregiver_user_id = ANY(:caregiver_user_id)', int, many=True),
+        'applied_since': Filter('ja.date_applied >= :applied_since', date),
+        'applied_before': Filter('ja.date_applied < :applied_before', date),
+    }, {'delete': None}),
+}
+
+
+class Edit:
+    """A validated bulk edit: its statements and bound parameters."""
+
+    def __init__(self, target, action, where, values):
+        if target not in TARGETS:
+            raise BulkEditError(f'Unknown target {target!r}; expected one of {", ".join(TARGETS)}')
+        spec = TARGETS[target]
+        if action not in spec.actions:
+            raise BulkEditError(f'{target} supports {", ".join(spec.actions)}, not {action!r}')
+        self.target = target
+        self.action = action
+        self.params = {}
+        conditions = []
+        where = dict(where or {})
+        everything = _parse(bool, 'all', where.pop('all', False))
+        for name, value in where.items():
+            if name not in spec.filters:
+                raise BulkEditError(f'Unknown filter {name!r} for {target}; expected {", ".join(spec.filters)}')
+            if value in (None, '', []):
+                continue
+            self.params[name] = spec.filters[name].parse(name, value)
+            conditions.append(spec.filters[name].condition)
+        if not conditions and not everything:
+            raise BulkEditError(f'No filters given; pass all=true to apply {action} to every row of {target}')
+
+        table = f'{spec.table} {spec.alias}'
+        key = ', '.join(f'{spec.alias}.{column}' for column in spec.key)
+        self.new_value = None
+        if spec.actions[action] is not None:
+            expression, params, column = spec.actions[action](spec, values or {})
+            self.params.update(params)
+            # Rows already at the new value are left alone, so their
+            # triggers do not fire for nothing.
+            conditions.append(f'{spec.alias}.{column} IS DISTINCT FROM {expression}')
+            self.column = column
+            self.new_value = expression
+        where_sql = ' AND '.join(conditions) or 'true'
+        self.count_sql = f'SELECT count(*) FROM {table} WHERE {where_sql}'
+        sample = key if self.new_value is None else \
+            f'{key}, {spec.alias}.{self.column}, {self.new_value} AS new_{self.column}'
+        self.sample_sql = f'SELECT {sample} FROM {table} WHERE {where_sql} ORDER BY {key} LIMIT {SAMPLE_ROWS}'
+        self.negative_sql = None
+        if self.new_value is not None and action == 'rate':
+            self.negative_sql = f'SELECT count(*) FROM {table} WHERE {where_sql} AND {self.new_value} < 0'
+        locked = f'SELECT {key} FROM {table} WHERE {where_sql} ORDER BY {key} FOR UPDATE'
+        keys = ', '.join(spec.key)
+        if self.new_value is None:
+            self.sql = f'DELETE FROM {table} WHERE ({keys}) IN ({locked})'
+        else:
+            # SET cannot name the alias, so the new value is computed in the
+            # locking subquery and joined back.
+            self.sql = (f'UPDATE {spec.table} SET {self.column} = locked.new_value '
+                        f'FROM (SELECT {key}, {self.new_value} AS new_value FROM {table} WHERE {where_sql} '
+                        f'ORDER BY {key} FOR UPDATE OF {spec.alias}) locked '
+                        f'WHERE ' + ' AND '.join(f'{spec.table}.{column} = locked.{column}' for column in spec.key))
+
+    def describe(self):
+        return {'target': self.target, 'action': self.action}
+
+
+def _jsonable(row):
+    return {key: str(value) if isinstance(value, (Decimal, date)) else value for key, value in row._mapping.items()}
+
+
+def run(connection, edit, dry_run=False):
+    """Apply ``edit`` (or just count it) on ``connection``; the caller commits."""
+    started = time.perf_counter()
+    result = edit.describe()
+    if dry_run:
+        result['dry_run'] = True
+        result['matched'] = connection.execute(text(edit.count_sql), edit.params).scalar()
+        result['sample'] = [_jsonable(row) for row in connection.execute(text(edit.sample_sql), edit.params)]
+        return result
+    if edit.negative_sql and connection.execute(text(edit.negative_sql), edit.params).scalar():
+        raise BulkEditError('the change would make some hourly rates negative')
+    try:
+        result['affected'] = connection.execute(text(edit.sql), edit.params).rowcount
+    except IntegrityError as e:
+        detail = getattr(getattr(e.orig, 'diag', None), 'message_detail', None)
+        problem = 'the change would double-book a caregiver' if scheduling.is_double_booking(e) \
+            else str(e.orig).splitlines()[0]
+        raise BulkEditError(f'{problem} ({detail})' if detail else problem)
+    result['dry_run'] = False
+    result['seconds'] = round(time.perf_counter() - started, 3)
+    return result
+
+
+def _pairs(pairs):
+    values = {}
+    for pair in pairs:
+        key, sep, value = pair.partition('=')
+        if not sep:
+            raise SystemExit(f'expected key=value, got {pair!r}')
+        values.setdefault(key, []).append(value)
+    return {key: items if len(items) > 1 else items[0] for key, items in values.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Set-based bulk edits over filtered rows.')
+    parser.add_argument('target', choices=sorted(TARGETS))
+    parser.add_argument('action')
+    parser.add_argument('where', nargs='*', metavar='filter=value', help='repeat a filter to match several values')
+    parser.add_argument('--set', action='append', default=[], metavar='key=value', dest='values')
+    parser.add_argument('--dry-run', action='store_true', help='count the matching rows without changing them')
+    args = parser.parse_intermixed_args(argv)
+
+    from migrations import get_engine
+    try:
+        edit = Edit(args.target, args.action, _pairs(args.where), _pairs(args.values))
+        with get_engine().begin() as connection:
+            result = run(connection, edit, args.dry_run)
+    except BulkEditError as e:
+        print(f'Bulk edit failed: {e}')
+        return 1
+    if args.dry_run:
+        for row in result['sample']:
+            print(json.dumps(row))
+        print(f'{result["matched"]} {args.target} would be changed by {args.action}')
+    else:
+        print(f'{result["affected"]} {args.target} changed by {args.action} in {result["seconds"]:.2f}s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
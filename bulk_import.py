@@ -0,0 +1,510 @@
+"""Bulk import of CSV / NDJSON files through PostgreSQL COPY.
+
+The file is streamed with COPY into a temporary staging table whose columns
+are all text, so nothing is rejected while loading. Validation then runs as
+a handful of set-based statements over the whole staging table (required
+fields, types, lengths, duplicate keys, foreign keys) and collects rejected
+rows with a reason. Everything that passes is merged into the real table
+with one INSERT ... SELECT, all inside a single transaction.
+
+Usage:
+    python bulk_import.py users users.csv
+    python bulk_import.py caregivers caregivers.ndjson --on-conflict update
+
+Load parents before children: users, then caregivers / members, then
+addresses and jobs, then applications and appointments.
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+import time
+
+from sqlalchemy import text
+
+import scheduling
+
+ON_CONFLICT_CHOICES = ('skip', 'update')
+MAX_REPORTED_REJECTS = 1000
+
+
+class Column:
+    def __init__(self, name, type_, required=False, length=None, precision=None, scale=None):
+        self.name = name
+        self.type = type_
+        self.required = required
+        self.length = length
+        self.precision = precision
+        self.scale = scale
+
+    @property
+    def sql_type(self):
+        if self.type == 'varchar':
+            return f'varchar({self.length})'
+        if self.type == 'numeric':
+            return f'numeric({self.precision}, {self.scale})'
+        return self.type
+
+
+class TableSpec:
+    """What an importable table looks like.
+
+    ``keys`` lists the unique keys, primary key first; ``serial`` names a
+    column filled from a sequence when the file does not provide it;
+    ``foreign_keys`` maps a column to the (table, column) it references.
+    A ``partitioned`` table has no unique index on its keys alone (the
+    partition column is part of its primary key), so rows are merged
+    without ON CONFLICT.
+    """
+
+    def __init__(self, table, columns, keys, serial=None, foreign_keys=None, partitioned=False):
+        self.table = table
+        self.columns = columns
+        self.keys = keys
+        self.serial = serial
+        self.foreign_keys = foreign_keys or {}
+        self.partitioned = partitioned
+
+    def column(self, name):
+        for column in self.columns:
+            if column.name == name:
+                return column
+        return None
+
+
+TABLES = {
+    'users': TableSpec('"USER"', [
+        Column('user_id', 'integer'),
+        Column('email', 'varchar', required=True, length=100),
+        Column('given_name', 'varchar', required=True, length=40),
+        Column('surname', 'varchar', required=True, length=40),
+        Column('city', 'varchar', length=30),
+        Column('phone_number', 'varchar', length=30),
+        Column('profile_description', 'text'),
+        Column('password', 'varchar', required=True, length=500),
+    ], keys=[('user_id',), ('email',)], serial='user_id'),
+    'caregivers': TableSpec('caregiver', [
+        Column('caregiver_user_id', 'integer', required=True),
+        Column('photo', 'varchar', length=300),
+        Column('gender', 'varchar', length=10),
+        Column('caregiving_type', 'varchar', required=True, length=30),
+        Column('hourly_rate', 'numeric', required=True, precision=10, scale=2),
+    ], keys=[('caregiver_user_id',)],
+        foreign_keys={'caregiver_user_id': ('"USER"', 'user_id')}),
+    'members': TableSpec('member', [
+        Column('member_user_id', 'integer', required=True),
+        Column('house_rules', 'text'),
+        Column('dependent_description', 'text'),
+    ], keys=[('member_user_id',)],
+        foreign_keys={'member_user_id': ('"USER"', 'user_id')}),
+    'addresses': TableSpec('address', [
+        Column('member_user_id', 'integer', required=True),
+        Column('house_number', 'varchar', length=30),
+        Column('street', 'varchar', required=True, length=50),
+        Column('town', 'varchar', length=30),
+    ], keys=[('member_user_id',)],
+        foreign_keys={'member_user_id': ('member', 'member_user_id')}),
+    'jobs': TableSpec('job', [
+        Column('job_id', 'integer'),
+        Column('member_user_id', 'integer', required=True),
+        Column('required_caregiving_type', 'varchar', required=True, length=30),
+        Column('other_requirements', 'text'),
+        Column('date_posted', 'date', required=True),
+    ], keys=[('job_id',)], serial='job_id',
+        foreign_keys={'member_user_id': ('member', 'member_user_id')}),
+    'applications': TableSpec('job_application', [
+        Column('caregiver_user_id', 'integer', required=True),
+        Column('job_id', 'integer', required=True),
+        Column('date_applied', 'date', required=True),
+    ], keys=[('caregiver_user_id', 'job_id')], partitioned=True,
+        foreign_keys={'caregiver_user_id': ('caregiver', 'caregiver_user_id'), 'job_id': ('job', 'job_id')}),
+    'appointments': TableSpec('appointment', [
+        Column('appointment_id', 'integer'),
+        Column('caregiver_user_id', 'integer', required=True),
+        Column('member_user_id', 'integer', required=True),
+        Column('appointment_date', 'date', required=True),
+        Column('appointment_time', 'time', required=True),
+        Column('work_hours', 'numeric', required=True, precision=5, scale=2),
+        Column('status', 'varchar', required=True, length=30),
+    ], keys=[('appointment_id',)], serial='appointment_id', partitioned=True,
+        foreign_keys={'caregiver_user_id': ('caregiver', 'caregiver_user_id'),
+                      'member_user_id': ('member', 'member_user_id')}),
+}
+
+
+class BulkImportError(Exception):
+    """The file as a whole cannot be imported (bad header, unknown table)."""
+
+
+class ImportResult:
+    def __init__(self, table, rows_read, rows_imported, rejects, reject_count, elapsed):
+        self.table = table
+        self.rows_read = rows_read
+        self.rows_imported = rows_imported
+        self.rejects = rejects
+        self.reject_count = reject_count
+        self.elapsed = elapsed
+
+    @property
+    def rows_per_second(self):
+        return round(self.rows_read / self.elapsed) if self.elapsed else 0
+
+    def as_dict(self):
+        return {
+            'table': self.table,
+            'rows_read': self.rows_read,
+            'rows_imported': self.rows_imported,
+            'rows_rejected': self.reject_count,
+            'rejects': [{'line': line, 'reason': reason} for line, reason in self.rejects],
+            'seconds': round(self.elapsed, 3),
+            'rows_per_second': self.rows_per_second,
+        }
+
+
+class ChunkReader:
+    """File-like object over an iterator of strings, for COPY FROM STDIN."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def _check_header(spec, header):
+    header = [name.strip() for name in header]
+    unknown = [name for name in header if spec.column(name) is None]
+    if unknown:
+        raise BulkImportError(f'Unknown column(s) for {spec.table}: {", ".join(unknown)}')
+    if len(set(header)) != len(header):
+        raise BulkImportError('Duplicate column names in header')
+    missing = [c.name for c in spec.columns if c.required and c.name not in header]
+    if missing:
+        raise BulkImportError(f'Missing required column(s): {", ".join(missing)}')
+    return header
+
+
+def _ndjson_rows(stream, columns, parse_rejects):
+    """Yield CSV text for NDJSON lines, prefixed with the line number."""
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    for number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError('not an object')
+        except ValueError as e:
+            parse_rejects.append((number, f'invalid JSON: {e}'))
+            continue
+        writer.writerow([number] + [_ndjson_value(record.get(name)) for name in columns])
+        if out.tell() > 65536:
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+    yield out.getvalue()
+
+
+def _ndjson_value(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def _peek_ndjson_columns(stream, spec):
+    """Read up to the first object to learn the columns; return them and the lines read."""
+    consumed = []
+    for line in stream:
+        consumed.append(line)
+        if line.strip():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict):
+                return _check_header(spec, [k for k in record if spec.column(k) is not None] or list(record)), consumed
+    raise BulkImportError('No JSON objects found')
+
+
+def _valid_expr(column, expr, has_input_is_valid):
+    """SQL that is true when the text ``expr`` casts cleanly to the column type."""
+    if column.type in ('varchar', 'text'):
+        if column.length:
+            return f'length({expr}) <= {column.length}'
+        return 'true'
+    if has_input_is_valid:
+        return f"pg_input_is_valid({expr}, '{column.sql_type}')"
+    if column.type == 'integer':
+        return (f"CASE WHEN {expr} ~ '^\\s*[+-]?\\d{{1,10}}\\s*$' "
+                f"THEN {expr}::numeric BETWEEN -2147483648 AND 2147483647 ELSE false END")
+    if column.type == 'numeric':
+        digits = column.precision - column.scale
+        return (f"CASE WHEN {expr} ~ '^\\s*[+-]?(\\d+\\.?\\d*|\\.\\d+)\\s*$' "
+                f"THEN abs(round({expr}::numeric, {column.scale})) < 1e{digits} ELSE false END")
+    if column.type == 'date':
+        return (f"{expr} ~ '^\\s*\\d{{4}}-(0?[1-9]|1[0-2])-(0?[1-9]|[12]\\d|3[01])\\s*$'")
+    if column.type == 'time':
+        return f"{expr} ~ '^\\s*([01]?\\d|2[0-3]):[0-5]\\d(:[0-5]\\d(\\.\\d+)?)?\\s*$'"
+    return 'true'
+
+
+def _server_has_input_is_valid(connection):
+    return connection.execute(text("SELECT current_setting('server_version_num')::int >= 160000")).scalar()
+
+
+def import_stream(connection, table, stream, fmt='csv', on_conflict='skip'):
+    """Import ``stream`` (text, CSV with header or NDJSON) into ``table``.
+
+    ``connection`` is a SQLAlchemy connection inside a transaction; the
+    caller commits. Returns an ImportResult.
+    """
+    if table not in TABLES:
+        raise BulkImportError(f'Unknown table {table!r}; expected one of {", ".join(TABLES)}')
+    if fmt not in ('csv', 'ndjson'):
+        raise BulkImportError(f'Unknown format {fmt!r}')
+    if on_conflict not in ON_CONFLICT_CHOICES:
+        raise BulkImportError(f'on_conflict must be one of {", ".join(ON_CONFLICT_CHOICES)}')
+    spec = TABLES[table]
+    started = time.perf_counter()
+    parse_rejects = []
+
+    if fmt == 'csv':
+        header_line = stream.readline()
+        if not header_line:
+            raise BulkImportError('Empty file')
+        columns = _check_header(spec, next(csv.reader([header_line])))
+    else:
+        columns, consumed = _peek_ndjson_columns(stream, spec)
+
+    connection.execute(text('DROP TABLE IF EXISTS import_staging, import_rejects, import_typed'))
+    staging_columns = ', '.join(f'{name} text' for name in columns)
+    connection.execute(text(
+        f'CREATE TEMP TABLE import_staging (_line bigserial, {staging_columns}) ON COMMIT DROP'
+    ))
+    connection.execute(text('CREATE TEMP TABLE import_rejects (_line bigint, reason text) ON COMMIT DROP'))
+
+    cursor = connection.connection.driver_connection.cursor()
+    column_list = ', '.join(columns)
+    if fmt == 'csv':
+        # Data records start on line 2, after the header.
+        cursor.execute('ALTER SEQUENCE import_staging__line_seq RESTART WITH 2')
+        cursor.copy_expert(f'COPY import_staging ({column_list}) FROM STDIN WITH (FORMAT csv)', stream)
+    else:
+        chunks = _ndjson_rows(_chain(consumed, stream), columns, parse_rejects)
+        cursor.copy_expert(f'COPY import_staging (_line, {column_list}) FROM STDIN WITH (FORMAT csv)',
+                           ChunkReader(chunks))
+    cursor.execute('ANALYZE import_staging')
+    rows_read = connection.execute(text('SELECT count(*) FROM import_staging')).scalar() + len(parse_rejects)
+
+    def reject(sql, params=None):
+        connection.execute(text(f'INSERT INTO import_rejects (_line, reason) {sql}'), params or {})
+
+    # 1. Required fields and types, on the raw text, in a single pass.
+    has_input_is_valid = _server_has_input_is_valid(connection)
+    checks = []
+    problems = []
+    for name in columns:
+        column = spec.column(name)
+        problem = f'is longer than {column.length} characters' if column.type == 'varchar' \
+            else f'is not a valid {column.sql_type}'
+        required = f"WHEN nullif(trim({name}), '') IS NULL THEN '{name} is required' " if column.required \
+            else f"WHEN nullif(trim({name}), '') IS NULL THEN NULL "
+        valid = _valid_expr(column, name, has_input_is_valid)
+        checks.append(f"(CASE {required}WHEN NOT ({valid}) THEN '{name} {problem}' END)")
+        if column.required:
+            problems.append(f"nullif(trim({name}), '') IS NULL")
+        if valid != 'true':
+            problems.append(f"(nullif(trim({name}), '') IS NOT NULL AND NOT ({valid}))")
+    if problems:
+        # The plain OR filters the (normally few) bad rows cheaply; only those
+        # are expanded into one reason per failing column.
+        reject(f'SELECT s._line, v.reason FROM import_staging s '
+               f'CROSS JOIN LATERAL (VALUES {", ".join(checks)}) AS v(reason) '
+               f'WHERE ({" OR ".join(problems)}) AND v.reason IS NOT NULL')
+
+    # 2. Cast the surviving rows once so every later check works on typed data.
+    casts = ', '.join(
+        f"nullif(trim({name}), '')::{spec.column(name).sql_type} AS {name}"
+        if spec.column(name).type not in ('varchar', 'text') else f'{name}'
+        for name in columns
+    )
+    connection.execute(text(
+        f'CREATE TEMP TABLE import_typed ON COMMIT DROP AS '
+        f'SELECT _line, {casts} FROM import_staging s '
+        f'WHERE NOT EXISTS (SELECT 1 FROM import_rejects r WHERE r._line = s._line)'
+    ))
+    connection.execute(text('ANALYZE import_typed'))
+
+    keys = [key for key in spec.keys if all(name in columns for name in key)]
+    conflict_key = keys[0] if keys else None
+
+    # 3. Duplicate keys inside the file: the first occurrence wins.
+    for key in keys:
+        key_list = ', '.join(key)
+        reject(f"SELECT _line, 'duplicate {key_list} in file' FROM ("
+               f'SELECT _line, row_number() OVER (PARTITION BY {key_list} ORDER BY _line) AS n '
+               f'FROM import_typed WHERE {" AND ".join(f"{k} IS NOT NULL" for k in key)}) d WHERE n > 1')
+
+    # 4. Keys that already exist. The conflict key is either skipped or
+    #    updated; any other unique key would abort the merge, so reject it.
+    for key in keys:
+        if key == conflict_key and on_conflict == 'update':
+            continue
+        match = ' AND '.join(f't.{k} = s.{k}' for k in key)
+        reason = 'already exists' if key == conflict_key else f'{", ".join(key)} already in use'
+        if key != conflict_key and on_conflict == 'update' and conflict_key:
+            # Updating the row that owns the key is fine.
+            match += ' AND NOT (' + ' AND '.join(f't.{k} = s.{k}' for k in conflict_key) + ')'
+        reject(f"SELECT s._line, '{reason}' FROM import_typed s "
+               f'WHERE EXISTS (SELECT 1 FROM {spec.table} t WHERE {match})')
+
+    # 5. Foreign keys.
+    for name, (parent, parent_column) in spec.foreign_keys.items():
+        if name not in columns:
+            continue
+        parent_name = parent.replace('"', '')
+        reject(f"SELECT s._line, '{name} ' || s.{name} || ' not found in {parent_name}' "
+               f'FROM import_typed s WHERE s.{name} IS NOT NULL AND NOT EXISTS '
+               f'(SELECT 1 FROM {parent} p WHERE p.{parent_column} = s.{name})')
+
+    # 6. Double bookings: a live appointment may not overlap a live booking
+    #    of the same caregiver, already stored or on an earlier line.
+    if spec.table == 'appointment':
+        _reject_double_bookings(connection, reject, columns, on_conflict)
+
+    # 7. Merge everything that was not rejected. Rows that leave the serial
+    #    column empty take the next sequence value; the sequence is first
+    #    moved past any explicit IDs in the file so the two cannot collide.
+    select_list = column_list
+    if spec.serial and spec.serial in columns:
+        sequence = f"pg_get_serial_sequence('{spec.table}', '{spec.serial}')"
+        connection.execute(text(
+            f'SELECT setval({sequence}, GREATEST('
+            f'(SELECT max({spec.serial}) FROM {spec.table}), '
+            f'(SELECT max({spec.serial}) FROM import_typed), '
+            f'nextval({sequence})))'
+        ))
+        select_list = ', '.join(
+            f'COALESCE(s.{name}, nextval({sequence}))' if name == spec.serial else f's.{name}'
+            for name in columns
+        )
+    kept = 'NOT EXISTS (SELECT 1 FROM import_rejects r WHERE r._line = s._line)'
+    insert = (f'INSERT INTO {spec.table} ({column_list}) '
+              f'SELECT {select_list} FROM import_typed s WHERE {kept}')
+    rows_imported = 0
+    if conflict_key and spec.partitioned:
+        # Update the rows that exist, then insert the others; the table's
+        # triggers still refuse a key that another writer just added.
+        match = ' AND '.join(f't.{k} = s.{k}' for k in conflict_key)
+        updates = [name for name in columns if name not in conflict_key]
+        if on_conflict == 'update' and updates:
+            rows_imported = connection.execute(text(
+                f'UPDATE {spec.table} t SET ' + ', '.join(f'{name} = s.{name}' for name in updates) +
+                f' FROM import_typed s WHERE {match} AND {kept}'
+            )).rowcount
+        insert += f' AND NOT EXISTS (SELECT 1 FROM {spec.table} t WHERE {match})'
+    elif conflict_key:
+        target = ', '.join(conflict_key)
+        updates = [name for name in columns if name not in conflict_key]
+        if on_conflict == 'update' and updates:
+            insert += f' ON CONFLICT ({target}) DO UPDATE SET ' + ', '.join(
+                f'{name} = EXCLUDED.{name}' for name in updates)
+        else:
+            insert += f' ON CONFLICT ({target}) DO NOTHING'
+    rows_imported += connection.execute(text(insert)).rowcount
+
+    reject_count = connection.execute(text('SELECT count(DISTINCT _line) FROM import_rejects')).scalar()
+    reject_count += len(parse_rejects)
+    rejects = [tuple(r) for r in connection.execute(text(
+        "SELECT _line, string_agg(reason, '; ') FROM import_rejects "
+        'GROUP BY _line ORDER BY _line LIMIT :limit'
+    ), {'limit': MAX_REPORTED_REJECTS})]
+    rejects = sorted(parse_rejects + rejects)[:MAX_REPORTED_REJECTS]
+    return ImportResult(table, rows_read, rows_imported, rejects, reject_count,
+                        time.perf_counter() - started)
+
+
+def _reject_double_bookings(connection, reject, columns, on_conflict):
+    not_rejected = 'NOT EXISTS (SELECT 1 FROM import_rejects r WHERE r._line = {0}._line)'
+    replaced = ''
+    if 'appointment_id' in columns and on_conflict == 'update':
+        # The row this line updates is about to be replaced.
+        replaced = 'AND t.appointment_id IS DISTINCT FROM s.appointment_id'
+    period = scheduling.period_sql('s')
+    window = scheduling.date_window_sql('t', 's.appointment_date', f'upper({period})::date')
+    reject(f"SELECT s._line, 'caregiver_user_id ' || s.caregiver_user_id || ' is already booked at that time' "
+           f'FROM import_typed s WHERE s.{scheduling.LIVE_SQL} AND {not_rejected.format("s")} '
+           f'AND EXISTS (SELECT 1 FROM appointment t WHERE t.caregiver_user_id = s.caregiver_user_id '
+           f'AND t.{scheduling.LIVE_SQL} AND t.period && {period} AND {window} {replaced})')
+    # Within the file the first line wins, but only over lines that were
+    # themselves kept, so the (normally few) overlapping pairs are settled
+    # in file order here.
+    pairs = connection.execute(text(
+        f'SELECT s._line, e._line FROM import_typed s JOIN import_typed e '
+        f'ON e.caregiver_user_id = s.caregiver_user_id AND e._line < s._line '
+        f'AND {scheduling.period_sql("e")} && {scheduling.period_sql("s")} '
+        f'WHERE s.{scheduling.LIVE_SQL} AND e.{scheduling.LIVE_SQL} '
+        f'AND {not_rejected.format("s")} AND {not_rejected.format("e")} '
+        f'ORDER BY s._line, e._line'
+    )).all()
+    lost = {}
+    for line, earlier in pairs:
+        if earlier not in lost and line not in lost:
+            lost[line] = earlier
+    if lost:
+        reject("SELECT line, 'overlaps line ' || earlier || ' for the same caregiver' "
+               'FROM unnest(CAST(:lines AS bigint[]), CAST(:earlier AS bigint[])) AS l(line, earlier)',
+               {'lines': list(lost), 'earlier': list(lost.values())})
+
+
+def _chain(first, rest):
+    yield from first
+    yield from rest
+
+
+def import_file(engine, table, path, fmt=None, on_conflict='skip'):
+    fmt = fmt or ('ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv')
+    with open(path, encoding='utf-8-sig', newline='') as stream:
+        with engine.begin() as connection:
+            return import_stream(connection, table, stream, fmt, on_conflict)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bulk import CSV / NDJSON through COPY.')
+    parser.add_argument('table', choices=sorted(TABLES))
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=('csv', 'ndjson'))
+    parser.add_argument('--on-conflict', choices=ON_CONFLICT_CHOICES, default='skip')
+    args = parser.parse_args(argv)
+
+    from migrations import get_engine
+    try:
+        result = import_file(get_engine(), args.table, args.path, args.format, args.on_conflict)
+    except BulkImportError as e:
+        print(f'Import failed: {e}')
+        return 1
+    for line, reason in result.rejects:
+        print(f'line {line}: {reason}')
+    print(f'{result.rows_imported} of {result.rows_read} rows imported into {args.table}, '
+          f'{result.reject_count} rejected, {result.elapsed:.2f}s ({result.rows_per_second} rows/s)')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
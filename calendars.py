@@ -0,0 +1,103 @@
+"""Date windows and iCalendar output for the appointment calendars.
+
+Caregivers and members each get a day, week or month view of their
+appointments, plus an iCalendar (RFC 5545) export. Every view is a date
+range on ``appointment_date`` for one caregiver or member, which the
+``(caregiver_user_id, appointment_date, appointment_time)`` and
+``(member_user_id, appointment_date, appointment_time)`` indexes of
+migrations 28 and 29 return already sorted.
+"""
+from datetime import date, datetime, timedelta, timezone
+
+VIEWS = ('day', 'week', 'month')
+# Window of the .ics feed when no view is asked for, so calendar apps that
+# subscribe to it see recent history and everything booked ahead.
+FEED_DAYS_BACK = 30
+FEED_DAYS_AHEAD = 365
+ICAL_STATUS = {'accepted': 'CONFIRMED', 'pending': 'TENTATIVE', 'declined': 'CANCELLED'}
+
+
+def parse_day(value):
+    try:
+        return date.fromisoformat(value) if value else date.today()
+    except ValueError:
+        return date.today()
+
+
+def window(view, day):
+    """``(start, end)`` dates of the view containing ``day``; end is exclusive.
+
+    Weeks start on Monday.
+    """
+    if view == 'day':
+        return day, day + timedelta(days=1)
+    if view == 'week':
+        start = day - timedelta(days=day.weekday())
+        return start, start + timedelta(days=7)
+    start = day.replace(day=1)
+    return start, (start + timedelta(days=32)).replace(day=1)
+
+
+def neighbours(view, day):
+    """First days of the previous and next windows."""
+    start, end = window(view, day)
+    return window(view, start - timedelta(days=1))[0], end
+
+
+def feed_window(today=None):
+    today = today or date.today()
+    return today - timedelta(days=FEED_DAYS_BACK), today + timedelta(days=FEED_DAYS_AHEAD)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def _fold(line):
+    """Split a content line into 75-octet pieces, as RFC 5545 requires."""
+    data = line.encode()
+    if len(data) <= 75:
+        return line
+    pieces = []
+    while data:
+        size = 75 if not pieces else 74
+        # Never cut a UTF-8 sequence in half.
+        while size < len(data) and (data[size] & 0xC0) == 0x80:
+            size -= 1
+        pieces.append(data[:size].decode())
+        data = data[size:]
+    return '\r\n '.join(pieces)
+
+
+def _timestamp(value):
+    return value.strftime('%Y%m%dT%H%M%S')
+
+
+def to_ical(name, events, host='caregiver-platform'):
+    """An iCalendar document for ``events``.
+
+    Each event is a dict with ``appointment_id``, ``start``, ``end``
+    (naive local datetimes), ``summary``, ``description`` and ``status``.
+    """
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//Caregiver Platform//Appointments//EN',
+        'CALSCALE:GREGORIAN',
+        f'X-WR-CALNAME:{_escape(name)}',
+    ]
+    for event in events:
+        lines += [
+            'BEGIN:VEVENT',
+            f'UID:appointment-{event["appointment_id"]}@{host}',
+            f'DTSTAMP:{stamp}',
+            f'DTSTART:{_timestamp(event["start"])}',
+            f'DTEND:{_timestamp(event["end"])}',
+            f'SUMMARY:{_escape(event["summary"])}',
+            f'DESCRIPTION:{_escape(event["description"])}',
+            f'STATUS:{ICAL_STATUS.get(event["status"], "TENTATIVE")}',
+            'END:VEVENT',
+        ]
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(_fold(line) for line in lines) + '\r\n'
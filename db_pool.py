@@ -0,0 +1,186 @@
+"""Connection pool settings and per-worker pool metrics.
+
+Pool sizing comes from the environment so it can be tuned per deployment
+without code changes:
+
+    DB_POOL_SIZE             connections kept open per worker (default 5)
+    DB_MAX_OVERFLOW          extra connections allowed under load (default 10)
+    DB_POOL_TIMEOUT          seconds to wait for a free connection (default 10)
+    DB_POOL_RECYCLE          seconds before a connection is replaced (default 1800)
+    DB_POOL_PRE_PING         check connections before use, 1/0 (default 1)
+    DB_STATEMENT_TIMEOUT_MS  server-side statement_timeout, 0 disables (default 30000)
+
+Under gunicorn.conf.py, serving.py sets the pool size and overflow from the
+worker's thread count unless they are given explicitly.
+"""
+import os
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+def env_int(environ, name, default):
+    value = environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+
+def env_bool(environ, name, default):
+    value = environ.get(name)
+    if value in (None, ''):
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+class PoolMetrics:
+    """Counters for one pool of the current process.
+
+    Every engine's pool carries its own (``pool.metrics``), so the primary
+    and the replica are counted apart. Every gunicorn worker has its own
+    pools, so these describe one worker; they are reset in the child after
+    a fork.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.checkouts = 0
+        self.overflow_checkouts = 0
+        self.timeouts = 0
+        self.invalidations = 0
+        self.connects = 0
+        self.peak_checked_out = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_checkout(self, pool, waited):
+        with self.lock:
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self.peak_checked_out = max(self.peak_checked_out, pool.checkedout())
+            if pool.overflow() > 0:
+                self.overflow_checkouts += 1
+
+    def record_timeout(self, waited):
+        with self.lock:
+            self.timeouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def snapshot(self, pool):
+        with self.lock:
+            data = {
+                'pid': os.getpid(),
+                'checkouts': self.checkouts,
+                'overflow_checkouts': self.overflow_checkouts,
+                'timeouts': self.timeouts,
+                'invalidations': self.invalidations,
+                'connects': self.connects,
+                'peak_checked_out': self.peak_checked_out,
+                'wait_ms_total': round(self.wait_total * 1000, 3),
+                'wait_ms_max': round(self.wait_max * 1000, 3),
+                'wait_ms_avg': round(self.wait_total * 1000 / self.checkouts, 3) if self.checkouts else 0.0,
+            }
+        if isinstance(pool, QueuePool):
+            data.update({
+                'pool_size': pool.size(),
+                'max_overflow': pool._max_overflow,
+                'checked_out': pool.checkedout(),
+                'checked_in': pool.checkedin(),
+                'overflow': max(pool.overflow(), 0),
+            })
+        return data
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def recreate(self):
+        # engine.dispose() swaps in a new pool; the counters carry over.
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            self.metrics.record_timeout(time.perf_counter() - started)
+            raise
+        self.metrics.record_checkout(self, time.perf_counter() - started)
+        return connection
+
+
+def snapshot(engine):
+    """The counters of ``engine``'s pool, or None if it is not instrumented."""
+    metrics = getattr(engine.pool, 'metrics', None)
+    return metrics.snapshot(engine.pool) if metrics is not None else None
+
+
+def engine_options(database_url, environ=os.environ):
+    """SQLALCHEMY_ENGINE_OPTIONS for ``database_url``.
+
+    Pool settings only apply to PostgreSQL; other URLs (e.g. sqlite for a
+    quick local run) keep SQLAlchemy's defaults.
+    """
+    if not database_url.startswith('postgresql'):
+        return {}
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': env_int(environ, 'DB_POOL_SIZE', 5),
+        'max_overflow': env_int(environ, 'DB_MAX_OVERFLOW', 10),
+        'pool_timeout': env_int(environ, 'DB_POOL_TIMEOUT', 10),
+        'pool_recycle': env_int(environ, 'DB_POOL_RECYCLE', 1800),
+        'pool_pre_ping': env_bool(environ, 'DB_POOL_PRE_PING', True),
+    }
+    statement_timeout = env_int(environ, 'DB_STATEMENT_TIMEOUT_MS', 30000)
+    if statement_timeout:
+        options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout}'}
+    return options
+
+
+def init_app(app, db):
+    """Hook pool events and make the engine fork-safe.
+
+    Connections opened before a fork (e.g. with ``gunicorn --preload``)
+    must never be used by two processes, so the child drops its inherited
+    pool without closing the parent's sockets and starts with fresh
+    counters.
+    """
+    def after_fork_in_child():
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+                if hasattr(engine.pool, 'metrics'):
+                    engine.pool.metrics.reset()
+
+    os.register_at_fork(after_in_child=after_fork_in_child)
+
+    with app.app_context():
+        for engine in db.engines.values():
+            if isinstance(engine.pool, InstrumentedQueuePool):
+                _count_events(engine)
+
+
+def _count_events(engine):
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        metrics = engine.pool.metrics
+        with metrics.lock:
+            metrics.connects += 1
+
+    @event.listens_for(engine, 'invalidate')
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        metrics = engine.pool.metrics
+        with metrics.lock:
+            metrics.invalidations += 1
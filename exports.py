@@ -0,0 +1,412 @@
+"""Streaming CSV, NDJSON and Parquet exports of the tables and reports.
+
+Every export is a SELECT read through a server-side cursor (``yield_per``,
+which makes psycopg2 use a named cursor) ``FETCH_SIZE`` rows at a time.
+Each batch is encoded and written out before the next one is fetched, so
+memory use is the same for a thousand rows as for fifty million. Over
+HTTP the batches go out as a chunked response:
+
+    GET /export/<name>.csv
+    GET /export/<name>.ndjson
+    GET /export/<name>.parquet          (needs pyarrow)
+
+Rows come in the order of the export's key, which every row includes and
+which the ``X-Export-Key`` header names. An interrupted export resumes
+after the last row received: ``?after=<key values>``, comma-separated in
+key order, e.g. ``/export/appointments.csv?after=2024-05-01,1234``. The
+CLI keeps a checkpoint file next to a CSV or NDJSON output and continues
+from it with ``--resume``.
+
+The report exports read the summary tables behind ``/reports`` (the
+queries.py section 6 and 7 reports) rather than aggregating appointments.
+
+Usage:
+    python exports.py                                            # list exports
+    python exports.py appointments --output appointments.csv
+    python exports.py appointments --output appointments.csv --resume
+    python exports.py caregiver-earnings --format parquet --output earnings.parquet
+"""
+import argparse
+import csv
+import datetime
+import io
+import json
+import os
+import sys
+from decimal import Decimal
+
+from flask import Response, jsonify, request, stream_with_context
+from sqlalchemy import text
+from sqlalchemy.exc import DataError
+
+from replica import read_only
+
+FETCH_SIZE = 5000
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+class ExportError(Exception):
+    pass
+
+
+class Export:
+    """A named SELECT and the unique key its rows are streamed and resumed in."""
+
+    def __init__(self, name, title, sql, key):
+        self.name = name
+        self.title = title
+        self.sql = sql
+        self.key = key
+
+    def statement(self, after=None):
+        key = ', '.join(self.key)
+        where = ''
+        if after is not None:
+            if len(after) != len(self.key):
+                raise ExportError(f'after needs {len(self.key)} values: {key}')
+            where = f'WHERE ({key}) > (' + ', '.join(f':after_{i}' for i in range(len(after))) + ')'
+        return text(f'SELECT * FROM ({self.sql}) e {where} ORDER BY {key}'), \
+            {f'after_{i}': value for i, value in enumerate(after or ())}
+
+
+EXPORTS = {export.name: export for export in [
+    Export('users', 'Users', """
+        SELECT user_id, email, given_name, surname, city, phone_number, profile_description FROM "USER"
+    """, ['user_id']),
+    Export('caregivers', 'Caregivers', """
+        SELECT caregiver_user_id, gender, caregiving_type, hourly_rate FROM caregiver
+    """, ['caregiver_user_id']),
+    Export('members', 'Members', """
+        SELECT member_user_id, house_rules, dependent_description FROM member
+    """, ['member_user_id']),
+    Export('addresses', 'Addresses', """
+        SELECT member_user_id, house_number, street, town FROM address
+    """, ['member_user_id']),
+    Export('jobs', 'Jobs', """
+        SELECT job_id, member_user_id, required_caregiving_type, other_requirements, date_posted FROM job
+    """, ['job_id']),
+    # Date first: the partitions are then read one month after another.
+    Export('applications', 'Job Applications', """
+        SELECT date_applied, job_id, caregiver_user_id FROM job_application
+    """, ['date_applied', 'job_id', 'caregiver_user_id']),
+    Export('appointments', 'Appointments', """
+        SELECT appointment_date, appointment_id, caregiver_user_id, member_user_id, appointment_time,
+               work_hours, status
+        FROM appointment
+    """, ['appointment_date', 'appointment_id']),
+    Export('applicant-counts', 'Applicants per Job', """
+        SELECT j.job_id, u.given_name AS member_name, u.surname AS member_surname,
+               j.required_caregiving_type, coalesce(c.applicants, 0) AS applicant_count
+        FROM job j
+        JOIN "USER" u ON u.user_id = j.member_user_id
+        LEFT JOIN job_applicant_counts c ON c.job_id = j.job_id
+    """, ['job_id']),
+    Export('caregiver-earnings', 'Hours, Average Payment and Earnings per Caregiver', """
+        SELECT e.caregiver_user_id, u.given_name, u.surname, c.caregiving_type, e.hourly_rate,
+               e.accepted_appointments, e.accepted_hours AS total_hours,
+               e.average_payment::numeric(12, 2) AS average_payment,
+               e.total_earnings::numeric(14, 2) AS total_earnings
+        FROM caregiver_earnings e
+        JOIN caregiver c ON c.caregiver_user_id = e.caregiver_user_id
+        JOIN "USER" u ON u.user_id = e.caregiver_user_id
+    """, ['caregiver_user_id']),
+    Export('above-average', 'Above-Average Earners', """
+        SELECT e.caregiver_user_id, u.given_name, u.surname, c.caregiving_type,
+               e.total_earnings::numeric(14, 2) AS total_earnings
+        FROM caregiver_earnings e
+        JOIN caregiver c ON c.caregiver_user_id = e.caregiver_user_id
+        JOIN "USER" u ON u.user_id = e.caregiver_user_id
+        WHERE e.total_earnings > (SELECT avg(total_earnings) FROM caregiver_earnings)
+    """, ['caregiver_user_id']),
+    Export('appointment-costs', 'Cost per Accepted Appointment', """
+        SELECT a.appointment_id, a.caregiver_user_id, uc.given_name AS caregiver_name,
+               uc.surname AS caregiver_surname, a.member_user_id, um.given_name AS member_name,
+               um.surname AS member_surname, a.work_hours, a.hourly_rate,
+               a.total_cost::numeric(16, 2) AS total_cost
+        FROM appointment_costs a
+        JOIN "USER" uc ON uc.user_id = a.caregiver_user_id
+        JOIN "USER" um ON um.user_id = a.member_user_id
+    """, ['appointment_id']),
+]}
+
+
+def _json_value(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    raise TypeError(f'cannot serialize {type(value).__name__}')
+
+
+def checkpoint_value(value):
+    """A key value as it appears in a checkpoint or an ``after`` argument."""
+    return _json_value(value) if isinstance(value, (Decimal, datetime.date, datetime.time)) else value
+
+
+def parse_after(raw):
+    """``after`` values from ``a,b``; Postgres casts each to its key column's type."""
+    return [value.strip() for value in raw.split(',')] if raw else None
+
+
+class CsvEncoder:
+    def __init__(self, columns, description, header=True):
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        if header:
+            self.writer.writerow(columns)
+
+    def encode(self, rows):
+        self.writer.writerows(rows)
+        return self._drain()
+
+    def finish(self):
+        return self._drain()
+
+    def _drain(self):
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data.encode()
+
+
+class NdjsonEncoder:
+    def __init__(self, columns, description, header=True):
+        self.columns = columns
+
+    def encode(self, rows):
+        return ''.join(json.dumps(dict(zip(self.columns, row)), default=_json_value) + '\n'
+                       for row in rows).encode()
+
+    def finish(self):
+        return b''
+
+
+class _Sink:
+    """Write-only file that hands over what was written since the last drain."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class ParquetEncoder:
+    """One Parquet row group per fetched batch; the footer comes with ``finish``."""
+
+    def __init__(self, columns, description, header=True):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ExportError('Parquet exports need pyarrow (pip install pyarrow)')
+        self.pa = pyarrow
+        self.schema = pyarrow.schema([(name, self._type(column)) for name, column in zip(columns, description)])
+        self.sink = _Sink()
+        self.writer = pyarrow.parquet.ParquetWriter(self.sink, self.schema, compression='snappy')
+
+    def _type(self, column):
+        pa = self.pa
+        types = {
+            16: pa.bool_(), 20: pa.int64(), 21: pa.int16(), 23: pa.int32(), 700: pa.float32(),
+            701: pa.float64(), 1082: pa.date32(), 1083: pa.time64('us'), 1114: pa.timestamp('us'),
+            1184: pa.timestamp('us', tz='UTC'),
+        }
+        if column.type_code == 1700 and column.precision:
+            return pa.decimal128(column.precision, column.scale or 0)
+        # Text, and numerics without a declared precision, go out as strings.
+        return types.get(column.type_code, pa.string())
+
+    def encode(self, rows):
+        arrays = []
+        for i, field in enumerate(self.schema):
+            values = [row[i] for row in rows]
+            if field.type == self.pa.string():
+                values = [None if value is None else str(value) for value in values]
+            arrays.append(self.pa.array(values, type=field.type))
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+        return self.sink.drain()
+
+    def finish(self):
+        self.writer.close()
+        return self.sink.drain()
+
+
+ENCODERS = {'csv': CsvEncoder, 'ndjson': NdjsonEncoder, 'parquet': ParquetEncoder}
+
+
+def stream(executor, export, fmt, after=None, header=True, fetch_size=FETCH_SIZE, checkpoint=None):
+    """Yield the export as encoded chunks, one per fetched batch.
+
+    ``executor`` is a Connection or Session. ``checkpoint(key, rows)`` is
+    called with the last key and the running row count after every chunk
+    has been consumed.
+    """
+    if fmt not in ENCODERS:
+        raise ExportError(f'format must be one of {", ".join(ENCODERS)}')
+    statement, params = export.statement(after)
+    result = executor.execute(statement, params, execution_options={'yield_per': fetch_size})
+    try:
+        columns = list(result.keys())
+        encoder = ENCODERS[fmt](columns, result.cursor.description, header)
+        positions = [columns.index(name) for name in export.key]
+        rows = 0
+        for batch in result.partitions(fetch_size):
+            yield encoder.encode(batch)
+            rows += len(batch)
+            if checkpoint:
+                checkpoint([checkpoint_value(batch[-1][i]) for i in positions], rows)
+        yield encoder.finish()
+    finally:
+        result.close()
+
+
+def init_app(app, db):
+    """Register ``/export/<name>.<format>``."""
+    @read_only
+    def export_view(name, fmt):
+        export = EXPORTS.get(name)
+        if export is None:
+            return jsonify(error=f'unknown export {name!r}; expected one of {", ".join(EXPORTS)}'), 404
+        try:
+            chunks = stream(db.session, export, fmt, parse_after(request.args.get('after')))
+            # Runs the query and builds the encoder, so errors still get a 400.
+            first = next(chunks)
+        except ExportError as e:
+            return jsonify(error=str(e)), 400
+        except DataError:
+            db.session.rollback()
+            return jsonify(error=f'after must be values of {", ".join(export.key)}'), 400
+
+        def body():
+            yield first
+            yield from chunks
+
+        return Response(stream_with_context(body()), mimetype=FORMATS[fmt], headers={
+            'Content-Disposition': f'attachment; filename={name}.{fmt}',
+            'X-Export-Key': ','.join(export.key),
+        })
+
+    app.add_url_rule('/export/<name>.<any(csv, ndjson, parquet):fmt>', 'export', export_view)
+
+
+def _read_checkpoint(path, export, fmt):
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        raise ExportError(f'no checkpoint at {path}; nothing to resume')
+    if (state['export'], state['format']) != (export.name, fmt):
+        raise ExportError(f'{path} is a checkpoint of {state["export"]}.{state["format"]}')
+    return state
+
+
+def _write_checkpoint(path, state):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def export_file(engine, export, fmt, output, checkpoint_path=None, resume=False, fetch_size=FETCH_SIZE,
+                progress=None):
+    """Write an export to ``output``, resumable through a checkpoint file.
+
+    The checkpoint holds the last key and the output size after each batch;
+    on resume the file is cut back to that size and continued. A Parquet
+    file is unreadable until its footer is written, so a Parquet export has
+    no checkpoint and is run again instead. Returns the rows written in
+    this run.
+    """
+    resumable = fmt != 'parquet'
+    checkpoint_path = checkpoint_path or output + '.checkpoint'
+    state = {'export': export.name, 'format': fmt, 'after': None, 'rows': 0, 'bytes': 0}
+    if resume:
+        if not resumable:
+            raise ExportError('a Parquet export cannot be resumed; run it again')
+        state = _read_checkpoint(checkpoint_path, export, fmt)
+    started = state['rows']
+    with open(output, 'r+b' if resume else 'wb') as f, engine.connect() as connection:
+        # Drops whatever was written after the last checkpoint.
+        f.truncate(state['bytes'])
+        f.seek(state['bytes'])
+
+        def checkpoint(key, rows):
+            state.update(after=key, rows=started + rows)
+            if resumable:
+                f.flush()
+                state['bytes'] = f.tell()
+                _write_checkpoint(checkpoint_path, state)
+            if progress:
+                progress(state['rows'])
+
+        for chunk in stream(connection, export, fmt, state['after'], header=not resume,
+                            fetch_size=fetch_size, checkpoint=checkpoint):
+            f.write(chunk)
+    if resumable and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return state['rows'] - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stream a table or report to CSV, NDJSON or Parquet.')
+    parser.add_argument('export', nargs='?', choices=sorted(EXPORTS))
+    parser.add_argument('--format', choices=sorted(ENCODERS), help='default: from the output file name, else csv')
+    parser.add_argument('--output', help='file to write (default: standard output, not resumable)')
+    parser.add_argument('--after', help='start after this key, comma-separated')
+    parser.add_argument('--resume', action='store_true', help='continue from the checkpoint of --output')
+    parser.add_argument('--checkpoint', help='checkpoint file (default: <output>.checkpoint)')
+    parser.add_argument('--fetch-size', type=int, default=FETCH_SIZE)
+    args = parser.parse_args(argv)
+
+    if args.export is None:
+        for export in EXPORTS.values():
+            print(f'{export.name:20} {export.title} (key: {", ".join(export.key)})')
+        return 0
+    fmt = args.format or (os.path.splitext(args.output)[1].lstrip('.') if args.output else '') or 'csv'
+    if fmt not in ENCODERS:
+        parser.error(f'cannot tell the format from {args.output}; use --format')
+    export = EXPORTS[args.export]
+
+    from migrations import get_engine
+    engine = get_engine()
+    try:
+        if args.output is None:
+            with engine.connect() as connection:
+                for chunk in stream(connection, export, fmt, parse_after(args.after), fetch_size=args.fetch_size):
+                    sys.stdout.buffer.write(chunk)
+            return 0
+        if args.after and not args.resume:
+            raise ExportError('--after only applies to standard output; use --resume with --output')
+        rows = export_file(engine, export, fmt, args.output, args.checkpoint, args.resume, args.fetch_size,
+                           progress=lambda rows: print(f'\r{rows} rows', end='', file=sys.stderr))
+    except ExportError as e:
+        print(e, file=sys.stderr)
+        return 1
+    print(f'\r{rows} rows written to {args.output}', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,23 @@
+"""gunicorn settings, sized by serving.py (``gunicorn -c gunicorn.conf.py app:app``)."""
+import os
+
+import serving
+
+_plan = serving.plan()
+# Must happen before the app is imported: db_pool reads these on startup.
+serving.export(_plan)
+
+bind = f'0.0.0.0:{os.environ.get("PORT", "8000")}'
+worker_class = _plan['worker_class']
+workers = _plan['workers']
+threads = _plan['threads']
+timeout = _plan['timeout']
+graceful_timeout = 30
+keepalive = 5
+# Restart workers now and then so a slow leak cannot grow without bound.
+max_requests = 5000
+max_requests_jitter = 500
+
+
+def on_starting(server):
+    server.log.info('Serving with %s', serving.describe(_plan))
@@ -0,0 +1,164 @@
+"""Opt-in per-request SQL instrumentation.
+
+When enabled, every request counts its SQL statements and the time spent in
+the database, groups statements by shape, and reports:
+
+* a ``Server-Timing`` header (``db``: DB time and statement count,
+  ``app``: total request time), visible in the browser dev tools;
+* one structured (JSON) log line per request on the ``sql`` logger;
+* a warning for every statement slower than the slow-query threshold, with
+  its bound parameters and the line of app code that issued it;
+* a warning when the same SELECT shape runs N or more times in a request,
+  the usual sign of an N+1 lazy-load pattern.
+
+Configuration (environment):
+
+    SQL_INSTRUMENTATION      1 to enable (default off)
+    SQL_SLOW_QUERY_MS        slow-query threshold (default 100)
+    SQL_N_PLUS_ONE           repetitions of one shape that count as N+1 (default 5)
+"""
+import json
+import logging
+import os
+import re
+import time
+import traceback
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+logger = logging.getLogger('sql')
+
+_PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+_IN_LIST = re.compile(r'\bIN \((?:[^()]|\([^()]*\))*\)', re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+
+
+def statement_shape(statement):
+    """Normalise a statement so repeats with different values compare equal.
+
+    Parameters are already placeholders; this only folds whitespace and
+    IN-lists of any length.
+    """
+    shape = _WHITESPACE.sub(' ', statement).strip()
+    return _IN_LIST.sub('IN (...)', shape)
+
+
+def call_site(depth=3):
+    """The innermost frames of the app's own code that led to a statement.
+
+    Returns e.g. ``pagination.py:157 in paginate <- app.py:301 in jobs``.
+    """
+    frames = []
+    for frame in reversed(traceback.extract_stack()[:-1]):
+        filename = os.path.abspath(frame.filename)
+        if filename.startswith(_PROJECT_DIR) and filename != os.path.abspath(__file__):
+            frames.append(f'{os.path.relpath(filename, _PROJECT_DIR)}:{frame.lineno} in {frame.name}')
+            if len(frames) == depth:
+                break
+    return ' <- '.join(frames) or None
+
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.db_time = 0.0
+        self.shapes = {}
+        self.slow = []
+        self.n_plus_one = {}
+
+    def as_log(self, status_code):
+        repeated = {shape: count for shape, count in self.shapes.items() if count > 1}
+        return {
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'status': status_code,
+            'duration_ms': round((time.perf_counter() - self.started) * 1000, 3),
+            'db_ms': round(self.db_time * 1000, 3),
+            'statements': self.statements,
+            'distinct_statements': len(self.shapes),
+            'repeated_statements': len(repeated),
+            'n_plus_one': [
+                {'statement': shape, 'count': self.shapes[shape], 'call_site': site}
+                for shape, site in self.n_plus_one.items()
+            ],
+            'slow_queries': self.slow,
+        }
+
+
+def _stats():
+    if not has_request_context():
+        return None
+    return g.get('_sql_stats')
+
+
+def init_app(app, db, environ=os.environ):
+    enabled = environ.get('SQL_INSTRUMENTATION', '').lower() in ('1', 'true', 'yes', 'on')
+    app.config.setdefault('SQL_INSTRUMENTATION', enabled)
+    app.config.setdefault('SQL_SLOW_QUERY_MS', float(environ.get('SQL_SLOW_QUERY_MS', 100)))
+    app.config.setdefault('SQL_N_PLUS_ONE', int(environ.get('SQL_N_PLUS_ONE', 5)))
+    if not app.config['SQL_INSTRUMENTATION']:
+        return
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+    slow_threshold = app.config['SQL_SLOW_QUERY_MS'] / 1000
+    n_plus_one = app.config['SQL_N_PLUS_ONE']
+
+    with app.app_context():
+        engines = list(db.engines.values())
+
+    for engine in engines:
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            # Kept on the statement's context rather than the connection: a
+            # statement that fails never reaches after_cursor_execute.
+            context._query_start = time.perf_counter()
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - context._query_start
+            stats = _stats()
+            if stats is None:
+                return
+            stats.statements += 1
+            stats.db_time += elapsed
+            shape = statement_shape(statement)
+            count = stats.shapes[shape] = stats.shapes.get(shape, 0) + 1
+            if count == n_plus_one and shape.upper().startswith('SELECT'):
+                site = call_site()
+                stats.n_plus_one[shape] = site
+                logger.warning(json.dumps({
+                    'event': 'n_plus_one', 'path': request.path, 'statement': shape,
+                    'count': count, 'call_site': site,
+                }))
+            if elapsed >= slow_threshold:
+                slow = {
+                    'statement': shape,
+                    'ms': round(elapsed * 1000, 3),
+                    'parameters': repr(parameters)[:1000],
+                    'call_site': call_site(),
+                }
+                stats.slow.append(slow)
+                logger.warning(json.dumps(dict(slow, event='slow_query', path=request.path)))
+
+    @app.before_request
+    def start_sql_stats():
+        g._sql_stats = RequestStats()
+
+    @app.after_request
+    def report_sql_stats(response):
+        stats = _stats()
+        if stats is None:
+            return response
+        total = (time.perf_counter() - stats.started) * 1000
+        timing = (f'db;dur={stats.db_time * 1000:.3f};desc="{stats.statements} queries", '
+                  f'app;dur={total:.3f}')
+        existing = response.headers.get('Server-Timing')
+        response.headers['Server-Timing'] = f'{existing}, {timing}' if existing else timing
+        logger.info(json.dumps(stats.as_log(response.status_code), default=str))
+        return response
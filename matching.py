@@ -0,0 +1,308 @@
+"""Job-to-caregiver matching with precomputed candidate lists.
+
+Caregivers are only matched to jobs of their own caregiving type. Within a
+type, ``match_score()`` (migration 23) adds up to 100 points:
+
+* 40 when the caregiver's ``USER.city`` is the member's ``address.town``;
+* up to 30 for a lower hourly rate (linear, $0 to $30 and up);
+* 10 per past accepted appointment between the pair, up to 3.
+
+The best ``MATCH_TOP_N`` caregivers of every job are kept in
+``job_candidates``, so the recommended caregivers panel is a primary-key
+range read. Scoring one job stays cheap because, apart from caregivers with
+history, its top N always come from the N cheapest same-city caregivers
+plus the N cheapest elsewhere, both read off ``caregiver_search`` indexes.
+
+Triggers queue work in ``match_queue`` instead of rescoring inside the
+writing transaction: a changed job, address or appointment queues the
+member's jobs; a changed caregiver queues itself. The refresher recomputes
+queued jobs and every list a changed caregiver is on; any other list whose
+cut-off score (``job_match.threshold``) the caregiver now reaches just takes
+it in and drops its last entry. Opening a job that is still queued scores
+it on the spot without storing the list, so a page view never writes; the
+refresher stores it.
+
+Usage:
+    python matching.py refresh              # drain the queue once
+    python matching.py refresh --watch 5    # keep draining every 5 seconds
+    python matching.py rebuild              # queue and recompute every job
+    python matching.py status
+"""
+import argparse
+import os
+import sys
+import time
+
+from sqlalchemy import text
+
+TOP_N = int(os.environ.get('MATCH_TOP_N', 10))
+BATCH_SIZE = 1000
+
+_LOCK_JOBS = text("""
+    SELECT job_id FROM job WHERE job_id = ANY(:job_ids) ORDER BY job_id FOR NO KEY UPDATE
+""")
+
+_DELETE_CANDIDATES = text('DELETE FROM job_candidates WHERE job_id = ANY(:job_ids)')
+
+# Scores the candidate pool of each job in :job_ids; ``ranked`` numbers
+# each job's caregivers best first.
+_RANKED = """
+    WITH jobs AS (
+        SELECT j.job_id, j.member_user_id, j.required_caregiving_type, a.town
+        FROM job j LEFT JOIN address a ON a.member_user_id = j.member_user_id
+        WHERE j.job_id = ANY(:job_ids)
+    ), history AS (
+        SELECT jobs.job_id, ap.caregiver_user_id, count(*) AS accepted
+        FROM jobs JOIN appointment ap ON ap.member_user_id = jobs.member_user_id AND ap.status = 'accepted'
+        GROUP BY jobs.job_id, ap.caregiver_user_id
+    ), pool AS (
+        SELECT jobs.job_id, p.caregiver_user_id
+        FROM jobs CROSS JOIN LATERAL (
+            (SELECT s.caregiver_user_id FROM caregiver_search s
+             WHERE s.city = jobs.town AND s.caregiving_type = jobs.required_caregiving_type
+             ORDER BY s.hourly_rate, s.caregiver_user_id LIMIT :top_n)
+            UNION ALL
+            (SELECT s.caregiver_user_id FROM caregiver_search s
+             WHERE s.caregiving_type = jobs.required_caregiving_type AND (s.city = jobs.town) IS NOT TRUE
+             ORDER BY s.hourly_rate, s.caregiver_user_id LIMIT :top_n)
+        ) p
+        UNION
+        SELECT job_id, caregiver_user_id FROM history
+    ), scored AS (
+        SELECT pool.job_id, s.caregiver_user_id, coalesce(s.city = jobs.town, false) AS same_city,
+               coalesce(h.accepted, 0) AS accepted, s.hourly_rate
+        FROM pool
+        JOIN jobs ON jobs.job_id = pool.job_id
+        JOIN caregiver_search s ON s.caregiver_user_id = pool.caregiver_user_id
+                               AND s.caregiving_type = jobs.required_caregiving_type
+        LEFT JOIN history h ON h.job_id = pool.job_id AND h.caregiver_user_id = pool.caregiver_user_id
+    ), ranked AS (
+        SELECT job_id, caregiver_user_id, same_city, accepted, score,
+               row_number() OVER (PARTITION BY job_id ORDER BY score DESC, caregiver_user_id) AS position
+        FROM (SELECT scored.*, match_score(same_city, hourly_rate, accepted) AS score FROM scored) s
+    )
+"""
+
+# Stores the new lists and each job's cut-off score: the score a caregiver
+# must reach to enter the list, or -1 while it is not full.
+_INSERT_CANDIDATES = text(_RANKED + """, inserted AS (
+        INSERT INTO job_candidates (job_id, caregiver_user_id, score, same_city, accepted_appointments)
+        SELECT job_id, caregiver_user_id, score, same_city, accepted FROM ranked
+        WHERE position <= :top_n
+        ORDER BY job_id, caregiver_user_id
+        RETURNING job_id, score
+    )
+    INSERT INTO job_match (job_id, caregiving_type, town, threshold, refreshed_at)
+    SELECT jobs.job_id, jobs.required_caregiving_type, jobs.town,
+           CASE WHEN coalesce(i.candidates, 0) < :top_n THEN -1 ELSE i.lowest END, now()
+    FROM jobs
+    LEFT JOIN (SELECT job_id, count(*) AS candidates, min(score) AS lowest FROM inserted GROUP BY job_id) i
+        ON i.job_id = jobs.job_id
+    ORDER BY jobs.job_id
+    ON CONFLICT (job_id) DO UPDATE SET
+        caregiving_type = EXCLUDED.caregiving_type, town = EXCLUDED.town,
+        threshold = EXCLUDED.threshold, refreshed_at = EXCLUDED.refreshed_at
+""")
+
+_SCORE_CANDIDATES = text(_RANKED + """
+    SELECT caregiver_user_id, score, same_city, accepted AS accepted_appointments
+    FROM ranked WHERE position <= :top_n
+    ORDER BY position
+""")
+
+_STALE = text("""
+    SELECT EXISTS (SELECT 1 FROM match_queue WHERE kind = 'job' AND id = :id)
+        OR NOT EXISTS (SELECT 1 FROM job_match WHERE job_id = :id)
+""")
+
+_LISTED_JOBS = text('SELECT DISTINCT job_id FROM job_candidates WHERE caregiver_user_id = ANY(:caregiver_ids)')
+
+# Scored (job, caregiver) pairs for lists these caregivers are not on but
+# now qualify for: same-city and other-city lists whose cut-off their rate
+# alone reaches, plus jobs of members they have accepted appointments with.
+_OFFERS = text("""
+    WITH offered AS (
+        SELECT caregiver_user_id, caregiving_type, city, hourly_rate
+        FROM caregiver_search WHERE caregiver_user_id = ANY(:caregiver_ids)
+    ), history AS (
+        SELECT j.job_id, ap.caregiver_user_id, count(*) AS accepted
+        FROM offered o
+        JOIN appointment ap ON ap.caregiver_user_id = o.caregiver_user_id AND ap.status = 'accepted'
+        JOIN job j ON j.member_user_id = ap.member_user_id AND j.required_caregiving_type = o.caregiving_type
+        GROUP BY j.job_id, ap.caregiver_user_id
+    ), pairs AS (
+        SELECT m.job_id, o.caregiver_user_id FROM offered o
+        JOIN job_match m ON m.caregiving_type = o.caregiving_type AND m.town = o.city
+                        AND m.threshold <= match_score(true, o.hourly_rate, 0)
+        UNION
+        SELECT m.job_id, o.caregiver_user_id FROM offered o
+        JOIN job_match m ON m.caregiving_type = o.caregiving_type
+                        AND m.threshold <= match_score(false, o.hourly_rate, 0)
+        UNION
+        SELECT job_id, caregiver_user_id FROM history
+    )
+    SELECT job_id, caregiver_user_id, score, same_city, accepted FROM (
+        SELECT p.job_id, p.caregiver_user_id, same.city AS same_city, coalesce(h.accepted, 0) AS accepted,
+               match_score(same.city, o.hourly_rate, coalesce(h.accepted, 0)) AS score, m.threshold
+        FROM pairs p
+        JOIN offered o ON o.caregiver_user_id = p.caregiver_user_id
+        JOIN job_match m ON m.job_id = p.job_id
+        CROSS JOIN LATERAL (SELECT coalesce(m.town = o.city, false) AS city) same
+        LEFT JOIN history h ON h.job_id = p.job_id AND h.caregiver_user_id = p.caregiver_user_id
+        WHERE p.job_id <> ALL(:skip_job_ids)
+    ) scored
+    WHERE score >= threshold
+    ORDER BY job_id, caregiver_user_id
+""")
+
+_INSERT_OFFERS = text("""
+    INSERT INTO job_candidates (job_id, caregiver_user_id, score, same_city, accepted_appointments)
+    SELECT * FROM unnest(CAST(:job_ids AS integer[]), CAST(:caregiver_ids AS integer[]),
+                         CAST(:scores AS real[]), CAST(:same_city AS boolean[]), CAST(:accepted AS integer[]))
+    ON CONFLICT DO NOTHING
+""")
+
+# Cuts lists that took offers back to N and moves their cut-off up.
+_TRIM = text("""
+    WITH ranked AS (
+        SELECT job_id, caregiver_user_id, score,
+               row_number() OVER (PARTITION BY job_id ORDER BY score DESC, caregiver_user_id) AS position
+        FROM job_candidates WHERE job_id = ANY(:job_ids)
+    ), dropped AS (
+        DELETE FROM job_candidates jc USING ranked r
+        WHERE jc.job_id = r.job_id AND jc.caregiver_user_id = r.caregiver_user_id AND r.position > :top_n
+    )
+    UPDATE job_match m SET threshold = t.threshold, refreshed_at = now()
+    FROM (
+        SELECT job_id, CASE WHEN count(*) < :top_n THEN -1 ELSE min(score) END AS threshold
+        FROM ranked WHERE position <= :top_n GROUP BY job_id
+    ) t
+    WHERE m.job_id = t.job_id
+""")
+
+# Caregivers go first: offered to lists that are about to be recomputed
+# anyway, they cost nothing, while offering them to freshly built lists
+# would rebuild every list they are on.
+_TAKE_QUEUED = text("""
+    DELETE FROM match_queue q USING (
+        SELECT kind, id FROM match_queue ORDER BY kind, queued_at LIMIT :limit FOR UPDATE SKIP LOCKED
+    ) batch
+    WHERE q.kind = batch.kind AND q.id = batch.id
+    RETURNING q.kind, q.id
+""")
+
+
+def recompute(connection, job_ids):
+    """Rescore ``job_ids`` from scratch and store their top N candidates."""
+    if not job_ids:
+        return
+    params = {'job_ids': sorted(job_ids), 'top_n': TOP_N}
+    connection.execute(_LOCK_JOBS, params)
+    connection.execute(_DELETE_CANDIDATES, params)
+    connection.execute(_INSERT_CANDIDATES, params)
+
+
+def offers(connection, caregiver_ids, skip_job_ids):
+    """Candidate rows for the lists changed caregivers now belong on.
+
+    Jobs in ``skip_job_ids`` are about to be recomputed and are left out.
+    """
+    return connection.execute(_OFFERS, {
+        'caregiver_ids': sorted(caregiver_ids), 'skip_job_ids': sorted(skip_job_ids),
+    }).all()
+
+
+def apply_offers(connection, rows):
+    """Insert offered candidates, then cut their lists back to N."""
+    if not rows:
+        return
+    connection.execute(_INSERT_OFFERS, {
+        'job_ids': [row.job_id for row in rows],
+        'caregiver_ids': [row.caregiver_user_id for row in rows],
+        'scores': [row.score for row in rows],
+        'same_city': [row.same_city for row in rows],
+        'accepted': [row.accepted for row in rows],
+    })
+    connection.execute(_TRIM, {'job_ids': sorted({row.job_id for row in rows}), 'top_n': TOP_N})
+
+
+def score_if_stale(connection, job_id):
+    """The top N candidates of a job that is queued or was never scored, else None.
+
+    Rows have ``caregiver_user_id``, ``score``, ``same_city`` and
+    ``accepted_appointments``, best first. Nothing is stored.
+    """
+    if not connection.execute(_STALE, {'id': job_id}).scalar():
+        return None
+    return connection.execute(_SCORE_CANDIDATES, {'job_ids': [job_id], 'top_n': TOP_N}).all()
+
+
+def refresh(engine, batch_size=BATCH_SIZE, log=None):
+    """Drain ``match_queue``, one transaction per batch.
+
+    Returns the number of jobs recomputed.
+    """
+    total = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(_TAKE_QUEUED, {'limit': batch_size}).all()
+            if not rows:
+                return total
+            jobs = {row.id for row in rows if row.kind == 'job'}
+            caregivers = [row.id for row in rows if row.kind == 'caregiver']
+            offered = []
+            if caregivers:
+                # A list that loses or rescores one of its caregivers is
+                # rebuilt; any other list only takes offers.
+                jobs |= {r.job_id for r in connection.execute(_LISTED_JOBS, {'caregiver_ids': caregivers})}
+                offered = offers(connection, caregivers, jobs)
+            # One ordered lock for everything this batch writes.
+            connection.execute(_LOCK_JOBS, {'job_ids': sorted(jobs | {row.job_id for row in offered})})
+            apply_offers(connection, offered)
+            recompute(connection, jobs)
+        total += len(jobs)
+        if log:
+            log(f'{len(rows)} queued changes: {len(jobs)} jobs recomputed, {len(offered)} candidates added')
+
+
+def queue_all(connection):
+    connection.execute(text(
+        "INSERT INTO match_queue (kind, id) SELECT 'job', job_id FROM job ON CONFLICT DO NOTHING"
+    ))
+
+
+def queue_status(connection):
+    rows = connection.execute(text('SELECT kind, count(*) AS queued FROM match_queue GROUP BY kind'))
+    return {row.kind: row.queued for row in rows}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Maintain the precomputed job candidate lists.')
+    parser.add_argument('command', choices=('refresh', 'rebuild', 'status'))
+    parser.add_argument('--watch', type=float, metavar='SECONDS',
+                        help='with refresh: keep polling the queue at this interval')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    from migrations import get_engine
+    engine = get_engine()
+    if args.command == 'status':
+        with engine.connect() as connection:
+            queued = queue_status(connection)
+        print(f"{queued.get('job', 0)} jobs and {queued.get('caregiver', 0)} caregivers queued")
+        return 0
+    if args.command == 'rebuild':
+        with engine.begin() as connection:
+            queue_all(connection)
+    while True:
+        started = time.monotonic()
+        jobs = refresh(engine, args.batch_size, log=print if args.watch is None else None)
+        if jobs or args.watch is None:
+            print(f'{jobs} jobs recomputed in {time.monotonic() - started:.1f}s')
+        if args.watch is None:
+            return 0
+        time.sleep(args.watch)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
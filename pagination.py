@@ -0,0 +1,235 @@
+"""Keyset (cursor) pagination for the list views.
+
+Instead of OFFSET, every page is fetched with a row-value comparison on the
+sort key of the last row seen, e.g. ``(date_posted, job_id) < (:d, :id)``.
+With a matching index Postgres can start the scan right at the cursor, so
+the cost of a page does not depend on how deep into the table it is.
+"""
+import base64
+import json
+import os
+from datetime import date, datetime, time
+from decimal import Decimal
+
+from flask import request, url_for
+from sqlalchemy import bindparam, tuple_
+
+DEFAULT_PER_PAGE = int(os.environ.get('PAGE_SIZE', 50))
+MAX_PER_PAGE = int(os.environ.get('MAX_PAGE_SIZE', 500))
+PER_PAGE_CHOICES = (25, 50, 100, 200)
+
+
+def encode_cursor(values):
+    payload = []
+    for value in values:
+        if isinstance(value, (date, datetime, time)):
+            payload.append(value.isoformat())
+        elif isinstance(value, Decimal):
+            payload.append(str(value))
+        else:
+            payload.append(value)
+    raw = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    """Turn a cursor back into python values typed like ``columns``.
+
+    Returns None for anything that does not decode cleanly, in which case
+    the caller simply starts from the first page.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(payload, list) or len(payload) != len(columns):
+            return None
+        values = []
+        for column, value in zip(columns, payload):
+            python_type = column.type.python_type
+            if python_type in (date, datetime, time):
+                values.append(python_type.fromisoformat(value))
+            elif python_type is Decimal:
+                values.append(Decimal(value))
+            else:
+                values.append(python_type(value))
+        return values
+    except (ValueError, TypeError, NotImplementedError, ArithmeticError):
+        return None
+
+
+def row_key(row, columns):
+    """Extract the sort key of a result row.
+
+    Rows can be a single model instance, a tuple of model instances
+    (``db.session.query(Job, Member, User)``), a row of bundles named after
+    their tables (see ``Listing``) or a plain column row.
+    """
+    entities = tuple(row) if not hasattr(row, '__table__') else (row,)
+    values = []
+    for column in columns:
+        owner = getattr(column, 'class_', None)
+        for entity in entities:
+            if owner is not None and isinstance(entity, owner):
+                values.append(getattr(entity, column.key))
+                break
+        else:
+            bundle = getattr(row, owner.__tablename__, None) if owner is not None else None
+            values.append(getattr(row if bundle is None else bundle, column.key))
+    return values
+
+
+def _per_page(args):
+    per_page = args.get('per_page', type=int) or DEFAULT_PER_PAGE
+    return max(1, min(per_page, MAX_PER_PAGE))
+
+
+class Page:
+    def __init__(self, items, per_page, sort, order, sorts, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.per_page = per_page
+        self.sort = sort
+        self.order = order
+        self.sorts = sorts
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.per_page_choices = PER_PAGE_CHOICES
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def url(self, **overrides):
+        """URL of the current view with the paging arguments replaced."""
+        args = request.args.to_dict(flat=False)
+        args.update(request.view_args or {})
+        for key in ('after', 'before'):
+            args.pop(key, None)
+        args.update(overrides)
+        return url_for(request.endpoint, **{k: v for k, v in args.items() if v is not None})
+
+    @property
+    def next_url(self):
+        return self.url(after=self.next_cursor) if self.has_next else None
+
+    @property
+    def prev_url(self):
+        return self.url(before=self.prev_cursor) if self.has_prev else None
+
+
+def _keyset(sorts, args, default_sort, default_order):
+    """``(sort, order, columns, per_page, cursor, backwards)`` asked for by ``args``."""
+    sort = args.get('sort', default_sort)
+    if sort not in sorts:
+        sort = default_sort
+    order = args.get('order', default_order)
+    if order not in ('asc', 'desc'):
+        order = default_order
+    columns = sorts[sort]
+    per_page = _per_page(args)
+
+    after = args.get('after')
+    before = args.get('before')
+    cursor = None
+    backwards = False
+    if before:
+        cursor = decode_cursor(before, columns)
+        backwards = cursor is not None
+    if cursor is None and after:
+        cursor = decode_cursor(after, columns)
+    return sort, order, columns, per_page, cursor, backwards
+
+
+def _page(rows, per_page, sort, order, sorts, cursor, backwards):
+    """The Page of ``rows``, fetched with one row more than ``per_page``."""
+    columns = sorts[sort]
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    next_cursor = prev_cursor = None
+    if backwards:
+        rows.reverse()
+        if rows:
+            next_cursor = encode_cursor(row_key(rows[-1], columns))
+            if has_more:
+                prev_cursor = encode_cursor(row_key(rows[0], columns))
+    elif rows:
+        if has_more:
+            next_cursor = encode_cursor(row_key(rows[-1], columns))
+        if cursor is not None:
+            prev_cursor = encode_cursor(row_key(rows[0], columns))
+    return Page(rows, per_page, sort, order, sorts, next_cursor, prev_cursor)
+
+
+def paginate(query, sorts, args, default_sort, default_order='asc'):
+    """Return one keyset page of ``query``.
+
+    ``sorts`` maps a sort name (the ``sort`` query argument) to a tuple of
+    columns that is unique per row, the last one normally being the primary
+    key so ties are broken deterministically. ``order`` is ``asc`` or
+    ``desc`` and applies to every column of the key. ``after``/``before``
+    carry the cursor of the last/first row of the neighbouring page.
+    """
+    sort, order, columns, per_page, cursor, backwards = _keyset(sorts, args, default_sort, default_order)
+    key = tuple_(*columns)
+    descending = (order == 'desc') != backwards
+    if cursor is not None:
+        bound = tuple_(*cursor)
+        query = query.filter(key < bound if descending else key > bound)
+    query = query.order_by(None).order_by(
+        *[column.desc() if descending else column.asc() for column in columns]
+    )
+    rows = query.limit(per_page + 1).all()
+    return _page(rows, per_page, sort, order, sorts, cursor, backwards)
+
+
+class Listing:
+    """The page statement of a list view, built once per sort order.
+
+    ``select`` is the unsorted statement of the rows, normally a select of
+    ``Bundle``s named after their tables, whose rows are plain tuples rather
+    than ORM instances with an identity. ``filters`` maps the name of an
+    optional criterion to an expression with a bind parameter of that name.
+
+    The statement for each sort, direction, cursor and set of filters is
+    built on first use and kept; later pages only bind new values, so
+    SQLAlchemy computes its cache key once and finds its compiled SQL in the
+    engine's cache.
+    """
+
+    def __init__(self, select, sorts, filters=None):
+        self.select = select
+        self.sorts = sorts
+        self.filters = filters or {}
+        self.statements = {}
+
+    def statement(self, sort, descending, with_cursor, filters=()):
+        key = (sort, descending, with_cursor, filters)
+        statement = self.statements.get(key)
+        if statement is None:
+            columns = self.sorts[sort]
+            statement = self.select.where(*[self.filters[name] for name in filters])
+            if with_cursor:
+                sort_key = tuple_(*columns)
+                bound = tuple_(*[bindparam(f'cursor_{i}', type_=column.type) for i, column in enumerate(columns)])
+                statement = statement.where(sort_key < bound if descending else sort_key > bound)
+            statement = statement.order_by(
+                *[column.desc() if descending else column.asc() for column in columns]
+            ).limit(bindparam('limit'))
+            self.statements[key] = statement
+        return statement
+
+    def paginate(self, session, args, default_sort, default_order='asc', **filters):
+        """One keyset page, like ``paginate``; ``filters`` set to None are left out."""
+        sort, order, columns, per_page, cursor, backwards = _keyset(self.sorts, args, default_sort, default_order)
+        descending = (order == 'desc') != backwards
+        params = {name: value for name, value in filters.items() if value is not None}
+        statement = self.statement(sort, descending, cursor is not None, tuple(sorted(params)))
+        params['limit'] = per_page + 1
+        if cursor is not None:
+            params.update((f'cursor_{i}', value) for i, value in enumerate(cursor))
+        rows = session.execute(statement, params).all()
+        return _page(rows, per_page, sort, order, self.sorts, cursor, backwards)
@@ -0,0 +1,196 @@
+"""Monthly partitions of appointment and job_application, and their archive.
+
+Migration 32 splits both tables into one partition per month
+(``appointment_2025_03``, ``job_application_2025_03``, ...) plus a
+``_default`` partition for dates outside them. Queries that filter on the
+date (the schedule, reports and availability searches) read only the
+months they need.
+
+``maintain`` keeps ``PARTITION_MONTHS_AHEAD`` months of partitions ahead of
+today and archives months older than ``PARTITION_RETENTION_MONTHS``. Rows
+that reached the default partition move into their month's partition once
+it is created. The task worker runs ``maintain`` once a day.
+
+Archiving a month moves its rows into ``archive.<partition>`` in batches
+of ``BATCH_SIZE``, each in its own transaction, then detaches and drops the
+empty partition. The rows are deleted through the parent table rather than
+by detaching the full partition, so the report, applicant count and listing
+triggers see them go. Archived rows can be queried, or copied back with
+``INSERT INTO appointment SELECT ... FROM archive.appointment_2023_12``.
+
+Configuration (environment):
+
+    PARTITION_MONTHS_AHEAD       months of partitions created ahead (default 12)
+    PARTITION_RETENTION_MONTHS   months kept before archiving (default 36; 0 keeps all)
+
+Usage:
+    python partitions.py                 # list partitions
+    python partitions.py maintain
+    python partitions.py archive appointment --before 2024-01-01
+"""
+import argparse
+import datetime
+import os
+import sys
+
+from sqlalchemy import text
+
+from db_pool import env_int
+from migrations import PARTITION_MONTHS_AHEAD, PARTITIONED_TABLES
+
+ARCHIVE_SCHEMA = 'archive'
+RETENTION_MONTHS = 36
+BATCH_SIZE = 5000
+
+_PARTITIONS = text("""
+    SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bounds,
+           greatest(c.reltuples, 0)::bigint AS rows
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = CAST(:table AS regclass)
+    ORDER BY c.relname
+""")
+
+_COLUMNS = text("""
+    SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) FROM pg_attribute
+    WHERE attrelid = CAST(:table AS regclass) AND attnum > 0 AND NOT attisdropped AND attgenerated = ''
+""")
+
+
+def months_ahead(environ=os.environ):
+    return env_int(environ, 'PARTITION_MONTHS_AHEAD', PARTITION_MONTHS_AHEAD)
+
+
+def retention_months(environ=os.environ):
+    return env_int(environ, 'PARTITION_RETENTION_MONTHS', RETENTION_MONTHS)
+
+
+def add_months(day, months):
+    month = day.year * 12 + day.month - 1 + months
+    return datetime.date(month // 12, month % 12 + 1, 1)
+
+
+def _month(name):
+    """First day of a monthly partition's month, or None for the default partition."""
+    try:
+        return datetime.datetime.strptime(name[-7:], '%Y_%m').date()
+    except ValueError:
+        return None
+
+
+def partitions(connection, table):
+    """(name, month, bounds, estimated rows) of every partition, oldest first."""
+    rows = connection.execute(_PARTITIONS, {'table': table}).all()
+    return [(row.name, _month(row.name), row.bounds, row.rows) for row in rows]
+
+
+def create_ahead(connection, table, today=None, months=None):
+    """Create the monthly partitions up to ``months`` ahead. Returns how many were new."""
+    today = today or datetime.date.today()
+    months = months_ahead() if months is None else months
+    return connection.execute(
+        text('SELECT create_month_partitions(CAST(:table AS regclass), :table, :first, :last)'),
+        {'table': table, 'first': add_months(today, 0), 'last': add_months(today, months)},
+    ).scalar()
+
+
+def archive(engine, table, month, batch_size=BATCH_SIZE, progress=None):
+    """Move a month's partition into the archive schema and drop it.
+
+    ``progress(moved)`` is called after every batch. Returns the rows moved.
+    """
+    column, keys = PARTITIONED_TABLES[table][:2]
+    name = f'{table}_{month:%Y_%m}'
+    with engine.begin() as connection:
+        if connection.execute(text('SELECT to_regclass(:name)'), {'name': name}).scalar() is None:
+            return 0
+        columns = connection.execute(_COLUMNS, {'table': table}).scalar()
+        connection.execute(text(f'CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}'))
+        connection.execute(text(
+            f'CREATE TABLE IF NOT EXISTS {ARCHIVE_SCHEMA}.{name} (LIKE {table} INCLUDING DEFAULTS INCLUDING GENERATED)'))
+    # The date range lets the DELETE touch only this partition.
+    statement = text(f"""
+        WITH moved AS (
+            DELETE FROM {table} WHERE {column} >= :start AND {column} < :end AND ({keys}) IN (
+                SELECT {keys} FROM {name} ORDER BY {keys} LIMIT :limit FOR UPDATE)
+            RETURNING {columns})
+        INSERT INTO {ARCHIVE_SCHEMA}.{name} ({columns}) SELECT {columns} FROM moved
+    """)
+    params = {'start': month, 'end': add_months(month, 1), 'limit': batch_size}
+    moved = 0
+    while True:
+        with engine.begin() as connection:
+            count = connection.execute(statement, params).rowcount
+        moved += count
+        if progress:
+            progress(moved)
+        if count < batch_size:
+            break
+    with engine.begin() as connection:
+        connection.execute(text("SET LOCAL lock_timeout = '10s'"))
+        # Rows written to the month since the last batch go with it.
+        moved += connection.execute(text(f"""
+            WITH moved AS (DELETE FROM {table} WHERE {column} >= :start AND {column} < :end RETURNING {columns})
+            INSERT INTO {ARCHIVE_SCHEMA}.{name} ({columns}) SELECT {columns} FROM moved
+        """), params).rowcount
+        connection.execute(text(f'ALTER TABLE {table} DETACH PARTITION {name}'))
+        connection.execute(text(f'DROP TABLE {name}'))
+    return moved
+
+
+def maintain(engine, today=None, ahead=None, retention=None, log=print):
+    """Create partitions ahead and archive expired months of every partitioned table."""
+    today = today or datetime.date.today()
+    retention = retention_months() if retention is None else retention
+    result = {}
+    for table in PARTITIONED_TABLES:
+        with engine.begin() as connection:
+            created = create_ahead(connection, table, today, ahead)
+            months = [month for _, month, _, _ in partitions(connection, table) if month is not None]
+        archived = {}
+        if retention > 0:
+            cutoff = add_months(today, -retention)
+            for month in months:
+                if month < cutoff:
+                    key = f'{month:%Y-%m}'
+                    archived[key] = archive(engine, table, month)
+                    log(f'{table} {key}: {archived[key]} rows archived')
+        if created:
+            log(f'{table}: {created} partitions created')
+        result[table] = {'created': created, 'archived': archived}
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='List, extend and archive the monthly partitions.')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('list', help='list partitions with estimated rows')
+    commands.add_parser('maintain', help='create partitions ahead and archive expired months')
+    archive_parser = commands.add_parser('archive', help='archive every month before a date')
+    archive_parser.add_argument('table', choices=sorted(PARTITIONED_TABLES))
+    archive_parser.add_argument('--before', type=datetime.date.fromisoformat, required=True)
+    archive_parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    from migrations import get_engine
+    engine = get_engine()
+    if args.command == 'maintain':
+        maintain(engine)
+    elif args.command == 'archive':
+        with engine.connect() as connection:
+            months = [month for _, month, _, _ in partitions(connection, args.table)
+                      if month is not None and add_months(month, 1) <= args.before]
+        for month in months:
+            moved = archive(engine, args.table, month, args.batch_size,
+                            progress=lambda moved: print(f'\r{args.table} {month:%Y-%m}: {moved} rows moved', end=''))
+            print(f'\r{args.table} {month:%Y-%m}: {moved} rows moved to {ARCHIVE_SCHEMA}.{args.table}_{month:%Y_%m}')
+    else:
+        with engine.connect() as connection:
+            for table in PARTITIONED_TABLES:
+                for name, _, bounds, rows in partitions(connection, table):
+                    print(f'{name:32} {rows:>9}  {bounds}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
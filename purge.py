@@ -0,0 +1,117 @@
+"""Deleting accounts: one cascading DELETE, or a batched purge.
+
+Every foreign key in the schema is ``ON DELETE CASCADE``, so deleting a
+user, caregiver or member is a single DELETE and the database removes the
+dependent rows. For an account with thousands of appointments, jobs and
+applications, that statement holds its locks and fires the report, count
+and listing triggers for all of them at once. ``purge`` removes the
+dependents ``BATCH_SIZE`` rows at a time, each batch in its own short
+transaction, and then deletes the account. The app switches to a
+background purge once an account has more than ``PURGE_THRESHOLD``
+dependent rows.
+
+A purge that is cancelled or fails leaves the account in place with some
+of its dependents gone; running it again finishes the job.
+
+Usage:
+    python purge.py user 42
+    python purge.py member 42 --batch-size 500
+"""
+import argparse
+import sys
+
+from sqlalchemy import text
+
+PURGE_THRESHOLD = 1000
+BATCH_SIZE = 1000
+
+# (table, key, condition on :id) for the rows that go with an account.
+CAREGIVER_ROWS = [
+    ('appointment', 'appointment_id', 'caregiver_user_id = :id'),
+    ('job_application', 'caregiver_user_id, job_id', 'caregiver_user_id = :id'),
+]
+MEMBER_ROWS = [
+    ('appointment', 'appointment_id', 'member_user_id = :id'),
+    ('job_application', 'caregiver_user_id, job_id', 'job_id IN (SELECT job_id FROM job WHERE member_user_id = :id)'),
+    ('job', 'job_id', 'member_user_id = :id'),
+]
+ACCOUNTS = {
+    'user': ('"USER"', 'user_id', CAREGIVER_ROWS + MEMBER_ROWS),
+    'caregiver': ('caregiver', 'caregiver_user_id', CAREGIVER_ROWS),
+    'member': ('member', 'member_user_id', MEMBER_ROWS),
+}
+
+
+def dependents(connection, kind, account_id, limit=None):
+    """Rows that deleting the account would cascade to, counting at most ``limit``."""
+    parts = ' UNION ALL '.join(f'(SELECT 1 FROM {table} WHERE {condition})'
+                               for table, _, condition in ACCOUNTS[kind][2])
+    capped = f' LIMIT {int(limit)}' if limit is not None else ''
+    return connection.execute(text(f'SELECT count(*) FROM ({parts}{capped}) d'), {'id': account_id}).scalar()
+
+
+def is_large(connection, kind, account_id):
+    return dependents(connection, kind, account_id, PURGE_THRESHOLD + 1) > PURGE_THRESHOLD
+
+
+def delete(connection, kind, account_id):
+    """Delete the account in one statement. Returns False if it did not exist."""
+    table, key, _ = ACCOUNTS[kind]
+    return bool(connection.execute(text(f'DELETE FROM {table} WHERE {key} = :id'), {'id': account_id}).rowcount)
+
+
+def purge(engine, kind, account_id, batch_size=BATCH_SIZE, progress=None):
+    """Delete the account's dependents in batches, then the account.
+
+    ``progress(done, total)`` is called after every batch. Returns the rows
+    deleted per table and whether the account itself existed.
+    """
+    rows = ACCOUNTS[kind][2]
+    with engine.connect() as connection:
+        total = dependents(connection, kind, account_id)
+    done = 0
+    deleted = {}
+    if progress:
+        progress(done, total)
+    for child, child_key, condition in rows:
+        # Rows are locked in key order, one batch per transaction, so no
+        # lock is held longer than one batch takes.
+        statement = text(f"""
+            DELETE FROM {child} WHERE ({child_key}) IN (
+                SELECT {child_key} FROM {child} WHERE {condition}
+                ORDER BY {child_key} LIMIT :limit FOR UPDATE)
+        """)
+        while True:
+            with engine.begin() as connection:
+                count = connection.execute(statement, {'id': account_id, 'limit': batch_size}).rowcount
+            deleted[child] = deleted.get(child, 0) + count
+            done += count
+            if progress:
+                progress(done, max(total, done))
+            if count < batch_size:
+                break
+    with engine.begin() as connection:
+        found = delete(connection, kind, account_id)
+    return {'kind': kind, 'id': account_id, 'found': found, 'deleted': deleted}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Delete an account and everything that depends on it in batches.')
+    parser.add_argument('kind', choices=sorted(ACCOUNTS))
+    parser.add_argument('id', type=int)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    from migrations import get_engine
+    result = purge(get_engine(), args.kind, args.id, args.batch_size,
+                   progress=lambda done, total: print(f'\r{done} of {total} dependent rows deleted', end=''))
+    print()
+    if not result['found']:
+        print(f'{args.kind} {args.id} not found')
+        return 1
+    print(f'{args.kind} {args.id} deleted: ' + ', '.join(f'{n} from {t}' for t, n in result['deleted'].items()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -552,8 +552,7 @@ JOIN job j ON ja.job_id = j.job_id
 JOIN member m ON j.member_user_id = m.member_user_id
 JOIN "USER" uMember ON m.member_user_id = uMember.user_id
 JOIN caregiver c ON ja.caregiver_user_id = c.caregiver_user_id
-JOIN "USER" uCare ON c.caregiver_user_id = uCare.user_id
-ORDER BY ja.date_applied DESC;
+JOIN "USER" uCare ON c.caregiver_user_id = uCare.user_id;
 """
 execute_query(create_view, fetch=False)
 
@@ -562,6 +561,7 @@ execute_query(create_view, fetch=False)
 print("8.2: Query the job_applications_view")
 query_view = """
 SELECT * FROM job_applications_view
+ORDER BY date_applied DESC
 LIMIT 10;
 """
 execute_query(query_view)
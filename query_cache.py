@@ -0,0 +1,415 @@
+"""Read-through cache for query results, invalidated per table.
+
+Queries opt in with an option naming the core tables their result depends
+on:
+
+    query.options(query_cache.cached('caregiver', 'USER'))
+
+The result is stored under the statement and its bound parameters, with
+the ``table_versions`` (migration 30) of those tables as they were when it
+was read. Every later lookup compares them with the current versions, read
+once per transaction, and a result whose tables have changed since is
+dropped and read again. Since the versions are bumped by triggers inside
+the writing transaction, this holds for writes from any worker, the task
+worker, bulk imports, cascades and psql alike. Reports read from the
+summary tables are tagged with the tables those are computed from.
+
+Commits through ``db.session`` also evict the entries of the tables they
+wrote, so this worker frees them at once. A transaction that has written
+anything bypasses the cache: it would see, and could store, its own
+uncommitted rows.
+
+Entries live in one of two backends:
+
+* ``memory``: an LRU in each worker process, bounded by entries and bytes;
+* ``file``: pickles in a directory shared by every worker on the machine,
+  by default under ``/dev/shm`` (memory-backed) when it exists.
+
+``GET /metrics/cache`` shows hits, misses and evictions (by reason) for the
+worker that served it, and the size of the backend.
+
+Configuration (environment):
+
+    QUERY_CACHE              memory (default), file, or off
+    QUERY_CACHE_TTL          seconds an entry is kept at most (default 300)
+    QUERY_CACHE_MAX_ENTRIES  entries kept per backend (default 1000)
+    QUERY_CACHE_MAX_MB       megabytes kept per backend (default 64)
+    QUERY_CACHE_DIR          directory of the file backend
+"""
+import collections
+import hashlib
+import os
+import pickle
+import re
+import tempfile
+import threading
+import time
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import UserDefinedOption, loading
+from sqlalchemy.util import LRUCache
+
+from db_pool import env_int
+from migrations import VERSIONED_TABLES
+
+BACKENDS = ('memory', 'file', 'off')
+DEFAULT_TTL = 300
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_MB = 64
+
+_VERSIONS_KEY = 'query_cache_versions'
+_WRITES_KEY = 'query_cache_writes'
+# pg_current_xact_id_if_assigned() is only set once the transaction has
+# written something, whichever way it was written.
+_VERSIONS = text("""
+    SELECT table_name, version, pg_current_xact_id_if_assigned() IS NOT NULL AS wrote
+    FROM table_versions
+""")
+_WRITE = re.compile(r'\s*(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM|TRUNCATE(?:\s+TABLE)?|MERGE\s+INTO)\s+'
+                    r'(?:ONLY\s+)?"?(\w+)"?', re.IGNORECASE)
+
+_Entry = collections.namedtuple('_Entry', 'tags versions expires data')
+
+
+class FromCache(UserDefinedOption):
+    """Statement option: serve the result from the cache, tagged with ``tables``."""
+
+    propagate_to_loaders = False
+
+    def __init__(self, tables):
+        unknown = set(tables) - set(VERSIONED_TABLES)
+        if unknown:
+            raise ValueError(f'not a versioned table: {", ".join(sorted(unknown))}')
+        super().__init__(tuple(sorted(tables)))
+
+    @property
+    def tables(self):
+        return self.payload
+
+
+def cached(*tables):
+    return FromCache(tables)
+
+
+class CacheMetrics:
+    """Lookups and evictions of the current process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.stores = 0
+        self.too_large = 0
+        self.evictions = {}
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def evicted(self, reason, count=1):
+        if count:
+            with self.lock:
+                self.evictions[reason] = self.evictions.get(reason, 0) + count
+
+    def snapshot(self, backend):
+        entries, size = backend.size() if backend else (0, 0)
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'pid': os.getpid(),
+                'backend': backend.name if backend else 'off',
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0,
+                'bypassed': self.bypassed,
+                'stores': self.stores,
+                'too_large': self.too_large,
+                'evictions': dict(self.evictions),
+                'entries': entries,
+                'bytes': size,
+                'max_entries': backend.max_entries if backend else 0,
+                'max_bytes': backend.max_bytes if backend else 0,
+                'ttl_seconds': backend.ttl if backend else 0,
+            }
+
+
+metrics = CacheMetrics()
+
+
+class MemoryBackend:
+    """Pickled results in an LRU of this process."""
+
+    name = 'memory'
+
+    def __init__(self, ttl, max_entries, max_bytes):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+
+    def _remove(self, key):
+        self.bytes -= len(self.entries.pop(key).data)
+
+    def get(self, key, tags):
+        """``(versions, data)`` of a live entry, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires < time.monotonic():
+                self._remove(key)
+                metrics.evicted('expired')
+                return None
+            self.entries.move_to_end(key)
+            return entry.versions, entry.data
+
+    def set(self, key, tags, versions, data):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = _Entry(tags, versions, time.monotonic() + self.ttl, data)
+            self.bytes += len(data)
+            evicted = 0
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                evicted += 1
+        metrics.evicted('capacity', evicted)
+
+    def discard(self, key, tags):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def evict(self, tables):
+        """Drop every entry tagged with one of ``tables``. Returns how many."""
+        with self.lock:
+            keys = [key for key, entry in self.entries.items() if not tables.isdisjoint(entry.tags)]
+            for key in keys:
+                self._remove(key)
+        return len(keys)
+
+    def size(self):
+        with self.lock:
+            return len(self.entries), self.bytes
+
+
+class FileBackend:
+    """Pickled results in a directory shared by the workers of this machine.
+
+    File names start with the entry's tags, so evicting a table only lists
+    the directory. The modification time is bumped on every hit and the
+    least recently used files go first when the directory is over its bounds.
+    """
+
+    name = 'file'
+
+    def __init__(self, ttl, max_entries, max_bytes, directory):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, tags):
+        return os.path.join(self.directory, f'{"+".join(tags)}.{key}')
+
+    def _files(self):
+        return [entry for entry in os.scandir(self.directory) if not entry.name.startswith('.')]
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+            return 1
+        except FileNotFoundError:
+            return 0
+
+    def clear(self):
+        for entry in self._files():
+            self._unlink(entry.path)
+
+    def get(self, key, tags):
+        path = self._path(key, tags)
+        try:
+            with open(path, 'rb') as f:
+                versions, expires, data = pickle.load(f)
+            os.utime(path)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires < time.time():
+            metrics.evicted('expired', self._unlink(path))
+            return None
+        return versions, data
+
+    def set(self, key, tags, versions, data):
+        fd, temporary = tempfile.mkstemp(dir=self.directory, prefix='.')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((versions, time.time() + self.ttl, data), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, self._path(key, tags))
+        self._trim()
+
+    def _trim(self):
+        files = []
+        for entry in self._files():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        count, size = len(files), sum(file[1] for file in files)
+        if count <= self.max_entries and size <= self.max_bytes:
+            return
+        evicted = 0
+        for _, file_size, path in sorted(files):
+            if count <= self.max_entries and size <= self.max_bytes:
+                break
+            evicted += self._unlink(path)
+            count, size = count - 1, size - file_size
+        metrics.evicted('capacity', evicted)
+
+    def discard(self, key, tags):
+        self._unlink(self._path(key, tags))
+
+    def evict(self, tables):
+        return sum(self._unlink(entry.path) for entry in self._files()
+                   if not tables.isdisjoint(entry.name.split('.', 1)[0].split('+')))
+
+    def size(self):
+        files = self._files()
+        total = 0
+        for entry in files:
+            try:
+                total += entry.stat().st_size
+            except FileNotFoundError:
+                pass
+        return len(files), total
+
+
+def default_directory():
+    root = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(root, 'caregiver-query-cache')
+
+
+def backend_from_env(environ=os.environ):
+    """The configured backend, or None when the cache is off."""
+    kind = environ.get('QUERY_CACHE') or 'memory'
+    if kind not in BACKENDS:
+        raise ValueError(f'QUERY_CACHE must be one of {", ".join(BACKENDS)}, not {kind!r}')
+    if kind == 'off':
+        return None
+    ttl = env_int(environ, 'QUERY_CACHE_TTL', DEFAULT_TTL)
+    max_entries = env_int(environ, 'QUERY_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)
+    max_bytes = env_int(environ, 'QUERY_CACHE_MAX_MB', DEFAULT_MAX_MB) * 1024 * 1024
+    if kind == 'file':
+        return FileBackend(ttl, max_entries, max_bytes, environ.get('QUERY_CACHE_DIR') or default_directory())
+    return MemoryBackend(ttl, max_entries, max_bytes)
+
+
+backend = None
+# Compiled SQL of each statement shape, for building keys.
+_statement_cache = LRUCache(500)
+
+
+def cache_key(statement, parameters):
+    key = statement._generate_cache_key().to_offline_string(_statement_cache, statement, parameters)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def table_versions(session):
+    """``({table: version}, wrote)`` for the session's transaction, read once."""
+    versions = session.info.get(_VERSIONS_KEY)
+    if versions is None:
+        rows = session.execute(_VERSIONS).all()
+        versions = ({row.table_name: row.version for row in rows}, any(row.wrote for row in rows))
+        session.info[_VERSIONS_KEY] = versions
+    return versions
+
+
+def _wrote(session, tables):
+    session.info.pop(_VERSIONS_KEY, None)
+    session.info.setdefault(_WRITES_KEY, set()).update(tables)
+
+
+def _on_execute(orm_context):
+    session = orm_context.session
+    if not orm_context.is_select:
+        statement = orm_context.statement
+        if orm_context.is_insert or orm_context.is_update or orm_context.is_delete:
+            _wrote(session, {statement.table.name})
+        else:
+            match = _WRITE.match(str(statement))
+            if match:
+                _wrote(session, {match.group(1)})
+        return None
+    option = next((option for option in orm_context.user_defined_options if isinstance(option, FromCache)), None)
+    if option is None:
+        return None
+    versions, wrote = table_versions(session)
+    if wrote or session.info.get(_WRITES_KEY):
+        metrics.count('bypassed')
+        return None
+
+    statement = orm_context.statement
+    key = cache_key(statement, orm_context.parameters)
+    current = {table: versions.get(table, 0) for table in option.tables}
+    entry = backend.get(key, option.tables)
+    if entry is not None and entry[0] != current:
+        backend.discard(key, option.tables)
+        metrics.evicted('stale')
+        entry = None
+    if entry is not None:
+        metrics.count('hits')
+        frozen = pickle.loads(entry[1])
+    else:
+        metrics.count('misses')
+        frozen = orm_context.invoke_statement().freeze()
+        data = pickle.dumps(frozen, pickle.HIGHEST_PROTOCOL)
+        if len(data) > backend.max_bytes:
+            metrics.count('too_large')
+        else:
+            backend.set(key, option.tables, current, data)
+            metrics.count('stores')
+    return loading.merge_frozen_result(session, statement, frozen, load=False)()
+
+
+def _after_flush(session, flush_context):
+    _wrote(session, {obj.__table__.name for obj in (*session.new, *session.dirty, *session.deleted)})
+
+
+def _after_commit(session):
+    tables = session.info.get(_WRITES_KEY)
+    if tables:
+        metrics.evicted('write', backend.evict(tables))
+
+
+def _after_transaction_end(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(_VERSIONS_KEY, None)
+        session.info.pop(_WRITES_KEY, None)
+
+
+def init_app(app, db, environ=os.environ):
+    """Serve queries carrying ``cached()`` from the configured backend."""
+    global backend
+    backend = backend_from_env(environ)
+    if backend is None:
+        return
+    event.listen(db.session, 'do_orm_execute', _on_execute)
+    event.listen(db.session, 'after_flush', _after_flush)
+    event.listen(db.session, 'after_commit', _after_commit)
+    event.listen(db.session, 'after_transaction_end', _after_transaction_end)
+
+    def after_fork():
+        metrics.reset()
+        if isinstance(backend, MemoryBackend):
+            backend.clear()
+
+    os.register_at_fork(after_in_child=after_fork)
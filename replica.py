@@ -0,0 +1,199 @@
+"""Read-replica routing for read-only views.
+
+When ``READ_DATABASE_URL`` points at a streaming replica, GET requests to
+views marked with ``@read_only`` (the list pages, searches, reports and the
+JSON API) run their queries on the replica; everything else stays on the
+primary. A request is kept on the primary when:
+
+* the view is not marked, or the method is not GET/HEAD;
+* the client wrote something in the last ``READ_AFTER_WRITE_SECONDS``, so
+  it sees its own change (a cookie set by any request that wrote);
+* the replica is more than ``REPLICA_MAX_LAG_SECONDS`` behind, or cannot be
+  reached.
+
+Lag is read from the replica at most once every ``REPLICA_LAG_CHECK_SECONDS``
+per worker. Flushes and INSERT/UPDATE/DELETE statements always go to the
+primary, even from a marked view. ``GET /metrics/replica`` shows how
+requests were routed and the last lag reading for the worker that served it.
+
+Configuration (environment):
+
+    READ_DATABASE_URL           replica connection string (unset: no routing)
+    REPLICA_MAX_LAG_SECONDS     skip the replica when it is further behind (default 5)
+    REPLICA_LAG_CHECK_SECONDS   how long one lag reading is trusted (default 1)
+    REPLICA_CONNECT_TIMEOUT     seconds to wait for the replica (default 2)
+    READ_AFTER_WRITE_SECONDS    reads from the primary after a write (default 10)
+"""
+import os
+import re
+import threading
+import time
+
+from flask import g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, text
+
+import db_pool
+from db_pool import env_int
+
+REPLICA_BIND = 'replica'
+PRIMARY_COOKIE = 'read_primary'
+# An unreachable replica is retried this often, not on every lag check.
+RETRY_SECONDS = 10
+
+_WRITE = re.compile(r'\s*(INSERT|UPDATE|DELETE|MERGE|TRUNCATE|COPY)\b', re.IGNORECASE)
+# Zero when the replica has replayed everything it received and is still
+# streaming; otherwise the age of the last replayed transaction. A server
+# that is not in recovery (e.g. the primary itself in development) has no lag.
+_LAG = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+             AND EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN 0
+        ELSE coalesce(extract(epoch FROM clock_timestamp() - pg_last_xact_replay_timestamp())::float8,
+                      'Infinity')
+    END
+""")
+
+
+def read_only(view):
+    """Mark a view whose GET requests may read from the replica."""
+    view.read_only = True
+    return view
+
+
+def binds(environ=os.environ):
+    """SQLALCHEMY_BINDS with the replica engine, or {} when none is configured."""
+    url = environ.get('READ_DATABASE_URL')
+    if not url:
+        return {}
+    if url.startswith('postgres://'):
+        url = url.replace('postgres://', 'postgresql://', 1)
+    options = db_pool.engine_options(url, environ)
+    connect_args = dict(options.get('connect_args', {}),
+                        connect_timeout=env_int(environ, 'REPLICA_CONNECT_TIMEOUT', 2))
+    return {REPLICA_BIND: dict(options, url=url, connect_args=connect_args)}
+
+
+class RoutingSession(Session):
+    """Session that runs the reads of a replica-routed request on the replica."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and has_request_context() and g.get('read_replica')
+                and not getattr(clause, 'is_dml', False)):
+            return self._db.engines[REPLICA_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class RoutingMetrics:
+    """Routing counters and the cached lag reading of the current process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.check_lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.replica = 0
+        self.primary = {}
+        self.lag_checks = 0
+        self.lag_check_failures = 0
+        self.lag_seconds = None
+        self.checked_at = None
+        self.last_error = None
+
+    def record(self, reason):
+        with self.lock:
+            if reason is None:
+                self.replica += 1
+            else:
+                self.primary[reason] = self.primary.get(reason, 0) + 1
+
+    def lag(self, engine, max_age):
+        """Seconds the replica is behind, or None if it could not be reached."""
+        # One thread checks while the others wait for its answer.
+        with self.check_lock:
+            if self.lag_seconds is None:
+                max_age = max(max_age, RETRY_SECONDS)
+            if self.checked_at is not None and time.monotonic() - self.checked_at < max_age:
+                return self.lag_seconds
+            try:
+                with engine.connect() as connection:
+                    lag = connection.execute(_LAG).scalar()
+                error = None
+            except Exception as e:
+                lag, error = None, str(e).splitlines()[0]
+            with self.lock:
+                self.lag_checks += 1
+                if error:
+                    self.lag_check_failures += 1
+                    self.last_error = error
+                self.lag_seconds = lag
+                self.checked_at = time.monotonic()
+            return lag
+
+    def snapshot(self):
+        with self.lock:
+            total = self.replica + sum(self.primary.values())
+            return {
+                'pid': os.getpid(),
+                'enabled': True,
+                'replica': self.replica,
+                'primary': dict(self.primary),
+                'replica_share': round(self.replica / total, 3) if total else 0.0,
+                'lag_seconds': self.lag_seconds,
+                'lag_checks': self.lag_checks,
+                'lag_check_failures': self.lag_check_failures,
+                'last_error': self.last_error,
+            }
+
+
+metrics = RoutingMetrics()
+
+
+def init_app(app, db, environ=os.environ):
+    """Route requests between the primary and the replica, if one is configured.
+
+    ``db`` must use ``RoutingSession`` and ``binds()`` must be in
+    ``SQLALCHEMY_BINDS``.
+    """
+    if REPLICA_BIND not in app.config.get('SQLALCHEMY_BINDS', {}):
+        return
+    max_lag = env_int(environ, 'REPLICA_MAX_LAG_SECONDS', 5)
+    check_every = env_int(environ, 'REPLICA_LAG_CHECK_SECONDS', 1)
+    read_after_write = env_int(environ, 'READ_AFTER_WRITE_SECONDS', 10)
+
+    def route():
+        if request.method not in ('GET', 'HEAD'):
+            return 'write_method'
+        if not getattr(app.view_functions[request.endpoint], 'read_only', False):
+            return 'not_read_only'
+        if request.cookies.get(PRIMARY_COOKIE):
+            return 'recent_write'
+        lag = metrics.lag(db.engines[REPLICA_BIND], check_every)
+        if lag is None:
+            return 'replica_unavailable'
+        if lag > max_lag:
+            return 'lagging'
+        g.read_replica = True
+        return None
+
+    @app.before_request
+    def choose_database():
+        g.read_replica = False
+        if request.endpoint is not None and request.endpoint != 'static':
+            metrics.record(route())
+
+    @app.after_request
+    def remember_write(response):
+        if g.get('db_wrote'):
+            response.set_cookie(PRIMARY_COOKIE, '1', max_age=read_after_write, httponly=True, samesite='Lax')
+        return response
+
+    with app.app_context():
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def on_execute(connection, cursor, statement, parameters, context, executemany):
+            if has_request_context() and _WRITE.match(statement):
+                g.db_wrote = True
+
+    os.register_at_fork(after_in_child=metrics.reset)
@@ -0,0 +1,182 @@
+"""Versioned JSON REST API over the seven core tables.
+
+    GET /api/v1/<resource>               keyset-paginated list
+    GET /api/v1/<resource>/<key>         one row
+
+List arguments: ``fields=a,b`` picks the fields returned; ``<field>=value``
+filters on any filterable field (repeat it to match several values);
+``sort``, ``order``, ``per_page``, ``after`` and ``before`` page through the
+results as on the HTML list pages.
+
+Every write to a core table bumps that table's row in ``table_versions``
+(migration 30), inside the writing transaction. Responses carry an
+``ETag`` built from the version and the request, and a ``Last-Modified``
+from the time of the last change. A conditional request
+(``If-None-Match`` or ``If-Modified-Since``) first reads just that one
+version row, and if nothing changed returns ``304 Not Modified`` without
+running the list query. Last-Modified only has one-second precision, so
+clients should prefer the ETag.
+"""
+import hashlib
+from datetime import date, datetime, time, timezone
+from decimal import Decimal, InvalidOperation
+
+from flask import Response, jsonify, make_response, request
+from sqlalchemy import inspect, text
+
+from pagination import paginate
+from replica import read_only
+
+API_VERSION = 'v1'
+
+_TABLE_STATE = text('SELECT version, changed_at FROM table_versions WHERE table_name = :table')
+
+
+class BadRequest(Exception):
+    pass
+
+
+class Resource:
+    """One model exposed through the API.
+
+    ``fields`` are the column attributes returned (never the password or
+    search columns), ``filters`` the subset that can be filtered on, and
+    ``sorts`` maps sort names to column tuples ending in the primary key.
+    """
+
+    def __init__(self, name, model, fields, filters=(), sorts=None, default_sort=None):
+        self.name = name
+        self.model = model
+        self.table = model.__table__.name
+        self.fields = list(fields)
+        self.filters = list(filters)
+        self.key = [column.key for column in inspect(model).primary_key]
+        self.sorts = sorts or {'id': tuple(getattr(model, name) for name in self.key)}
+        self.default_sort = default_sort or next(iter(self.sorts))
+
+    def column(self, name):
+        return getattr(self.model, name)
+
+
+def serialize(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (date, datetime, time)):
+        return value.isoformat()
+    return value
+
+
+def parse_value(column, raw):
+    python_type = column.type.python_type
+    try:
+        if python_type in (date, datetime, time):
+            return python_type.fromisoformat(raw)
+        if python_type is Decimal:
+            return Decimal(raw)
+        return python_type(raw)
+    except (ValueError, TypeError, InvalidOperation):
+        raise BadRequest(f'{column.key} must be a valid {python_type.__name__}')
+
+
+def table_state(session, table):
+    row = session.execute(_TABLE_STATE, {'table': table}).first()
+    if row is None:
+        return 0, None
+    return row.version, row.changed_at
+
+
+def _etag(resource, version):
+    """Changes with the table version and with anything in the request."""
+    query = '&'.join(f'{k}={v}' for k, v in sorted(request.args.items(multi=True)))
+    digest = hashlib.sha1(f'{request.path}?{query}'.encode()).hexdigest()[:16]
+    return f'{resource.name}-{version}-{digest}'
+
+
+def _not_modified(etag, changed_at):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    if since is not None and changed_at is not None:
+        return changed_at.astimezone(timezone.utc).replace(microsecond=0) <= since
+    return False
+
+
+def _with_validators(response, etag, changed_at):
+    response.set_etag(etag)
+    if changed_at is not None:
+        response.last_modified = changed_at
+    # Cache, but revalidate every time: the version check is cheap.
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def conditional(session, resource, build):
+    """Answer 304 if the table has not changed, else ``build()`` with validators."""
+    version, changed_at = table_state(session, resource.table)
+    etag = _etag(resource, version)
+    if _not_modified(etag, changed_at):
+        return _with_validators(Response(status=304), etag, changed_at)
+    try:
+        response = make_response(build())
+    except BadRequest as e:
+        return jsonify(error=str(e)), 400
+    return _with_validators(response, etag, changed_at)
+
+
+def selected_fields(resource):
+    raw = request.args.get('fields')
+    if not raw:
+        return resource.fields
+    fields = [name.strip() for name in raw.split(',') if name.strip()]
+    unknown = [name for name in fields if name not in resource.fields]
+    if unknown:
+        raise BadRequest(f'unknown fields: {", ".join(unknown)}; expected some of {", ".join(resource.fields)}')
+    return fields
+
+
+def list_rows(session, resource):
+    fields = selected_fields(resource)
+    query = session.query(resource.model)
+    for name in resource.filters:
+        values = request.args.getlist(name)
+        if values:
+            column = resource.column(name)
+            parsed = [parse_value(column, value) for value in values]
+            query = query.filter(column == parsed[0] if len(parsed) == 1 else column.in_(parsed))
+    page = paginate(query, resource.sorts, request.args, resource.default_sort)
+    return jsonify(
+        results=[{name: serialize(getattr(row, name)) for name in fields} for row in page.items],
+        sort=page.sort,
+        order=page.order,
+        next_cursor=page.next_cursor,
+        prev_cursor=page.prev_cursor,
+    )
+
+
+def get_row(session, resource, key):
+    fields = selected_fields(resource)
+    row = session.get(resource.model, tuple(key[name] for name in resource.key))
+    if row is None:
+        return jsonify(error=f'{resource.name} not found'), 404
+    return jsonify({name: serialize(getattr(row, name)) for name in fields})
+
+
+def init_app(app, db, resources):
+    """Register the list and item routes of every resource."""
+    def list_view(resource):
+        @read_only
+        def view():
+            return conditional(db.session, resource, lambda: list_rows(db.session, resource))
+        return view
+
+    def item_view(resource):
+        @read_only
+        def view(**key):
+            return conditional(db.session, resource, lambda: get_row(db.session, resource, key))
+        return view
+
+    for resource in resources:
+        base = f'/api/{API_VERSION}/{resource.name}'
+        app.add_url_rule(base, f'api_{API_VERSION}_{resource.name}', list_view(resource))
+        item = '/'.join(f'<int:{name}>' for name in resource.key)
+        app.add_url_rule(f'{base}/{item}', f'api_{API_VERSION}_{resource.name}_item', item_view(resource))
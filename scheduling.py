@@ -0,0 +1,89 @@
+"""Double-booking checks and caregiver availability.
+
+``appointment.period`` (migration 27) is the ``tsrange`` an appointment
+occupies, generated from its date, time and work hours. The
+``appointment_no_double_booking`` check keeps a caregiver's live (accepted
+or pending) bookings from overlapping, so the database rejects a double
+booking no matter which code path writes it. It began as an exclusion
+constraint; since appointment is partitioned by month (migration 32) it is
+a trigger that raises the same error. The GiST index on
+``(period, caregiver_user_id)`` serves availability, and a bound on
+``appointment_date`` limits the search to the partitions a window can
+reach: a booking starts at most ``MAX_BOOKING_DAYS`` before it ends.
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import exists, func
+
+LIVE_STATUSES = ('accepted', 'pending')
+LIVE_SQL = "status IN ('accepted', 'pending')"
+CONSTRAINT = 'appointment_no_double_booking'
+EXCLUSION_VIOLATION = '23P01'
+# work_hours is numeric(5, 2); as in migration 32's check.
+MAX_BOOKING_DAYS = 42
+
+
+def period_sql(alias):
+    """SQL for the period of the appointment-shaped row ``alias``, as generated in migration 27."""
+    start = f'{alias}.appointment_date + {alias}.appointment_time'
+    return f"tsrange({start}, {start} + greatest({alias}.work_hours, 0) * interval '1 hour')"
+
+
+def date_window_sql(alias, start, end):
+    """SQL bounding ``alias.appointment_date`` for bookings that can overlap [start, end].
+
+    ``start`` and ``end`` are SQL date expressions.
+    """
+    return f'{alias}.appointment_date BETWEEN ({start}) - {MAX_BOOKING_DAYS} AND ({end})'
+
+
+def date_window(appointment, start, end):
+    """Condition on appointment_date that lets a [start, end) search skip partitions."""
+    return appointment.appointment_date.between(start.date() - timedelta(days=MAX_BOOKING_DAYS), end.date())
+
+
+def parse_window(args):
+    """``(start, end)`` from the ``start`` and ``end`` query arguments.
+
+    Both are ISO datetimes such as ``2025-06-07T09:00``. Raises ValueError
+    with a message for the user when they are missing or out of order.
+    """
+    try:
+        start = datetime.fromisoformat(args.get('start', ''))
+        end = datetime.fromisoformat(args.get('end', ''))
+    except ValueError:
+        raise ValueError('start and end must be ISO datetimes, e.g. 2025-06-07T09:00')
+    if end <= start:
+        raise ValueError('end must be after start')
+    return start, end
+
+
+def busy(appointment, caregiver_id, start, end):
+    """Condition: the caregiver has a live booking overlapping [start, end)."""
+    return exists().where(
+        appointment.caregiver_user_id == caregiver_id,
+        appointment.status.in_(LIVE_STATUSES),
+        appointment.period.op('&&')(func.tsrange(start, end)),
+        date_window(appointment, start, end),
+    )
+
+
+def conflicts(session, appointment, caregiver_id, start, end, exclude_id=None):
+    """Live bookings of the caregiver overlapping [start, end), earliest first."""
+    query = session.query(appointment).filter(
+        appointment.caregiver_user_id == caregiver_id,
+        appointment.status.in_(LIVE_STATUSES),
+        appointment.period.op('&&')(func.tsrange(start, end)),
+        date_window(appointment, start, end),
+    )
+    if exclude_id is not None:
+        query = query.filter(appointment.appointment_id != exclude_id)
+    return query.order_by(appointment.period).all()
+
+
+def is_double_booking(error):
+    """True if an IntegrityError came from the double-booking check."""
+    orig = getattr(error, 'orig', None)
+    diag = getattr(orig, 'diag', None)
+    return getattr(orig, 'pgcode', None) == EXCLUSION_VIOLATION and \
+        getattr(diag, 'constraint_name', None) == CONSTRAINT
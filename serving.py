@@ -0,0 +1,122 @@
+"""Worker, thread and connection-pool sizing for the web server.
+
+The app spends most of a request waiting on PostgreSQL, and psycopg2
+releases the GIL while it waits, so gunicorn's threaded worker
+(``gthread``) serves several requests per process at once. Every thread
+needs its own connection, so the pool of each worker is sized from its
+thread count, and the total across workers is kept within the database's
+connection limit:
+
+    connections = workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+               <= DB_MAX_CONNECTIONS - DB_RESERVED_CONNECTIONS
+
+Configuration (environment), all optional:
+
+    WEB_WORKER_CLASS         gthread (default) or sync
+    WEB_CONCURRENCY          worker processes (default: one per CPU)
+    WEB_THREADS              threads per worker (default 4; 1 for sync)
+    WEB_TIMEOUT              seconds before a silent worker is restarted (default 60)
+    DB_MAX_CONNECTIONS       connections this server may open; default is the
+                             server's max_connections less its superuser slots
+    DB_RESERVED_CONNECTIONS  connections left for the release, task and
+                             matching workers and psql (default 10)
+
+``DB_POOL_SIZE`` and ``DB_MAX_OVERFLOW`` (see db_pool.py) still win when set.
+If the budget cannot give every thread a connection, threads and then
+workers are reduced to fit. Several web servers sharing one database
+should each set ``DB_MAX_CONNECTIONS`` to their share.
+
+Usage:
+    python serving.py            # print the plan for this machine
+"""
+import argparse
+import json
+import os
+import sys
+
+from db_pool import env_int
+
+WORKER_CLASSES = ('gthread', 'sync')
+DEFAULT_THREADS = 4
+DEFAULT_RESERVED = 10
+FALLBACK_MAX_CONNECTIONS = 100
+# Connections per thread: a request can hold its session's connection while
+# another one runs a separate transaction (engine.begin() for a task).
+OVERFLOW_PER_THREAD = 1
+
+
+def server_max_connections(database_url):
+    """max_connections less superuser_reserved_connections, or None if unreachable."""
+    if not database_url or not database_url.startswith('postgresql'):
+        return None
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.pool import NullPool
+    try:
+        engine = create_engine(database_url, poolclass=NullPool, connect_args={'connect_timeout': 5})
+        with engine.connect() as connection:
+            return connection.execute(text(
+                "SELECT current_setting('max_connections')::int"
+                " - current_setting('superuser_reserved_connections')::int")).scalar()
+    except Exception:
+        return None
+
+
+def plan(environ=os.environ, cpu_count=None, max_connections=None):
+    """Workers, threads and per-worker pool sizes for this machine and database."""
+    worker_class = environ.get('WEB_WORKER_CLASS') or 'gthread'
+    if worker_class not in WORKER_CLASSES:
+        raise ValueError(f'WEB_WORKER_CLASS must be one of {", ".join(WORKER_CLASSES)}, not {worker_class!r}')
+    cpus = cpu_count or os.cpu_count() or 1
+    workers = env_int(environ, 'WEB_CONCURRENCY', cpus)
+    threads = 1 if worker_class == 'sync' else env_int(environ, 'WEB_THREADS', DEFAULT_THREADS)
+
+    if max_connections is None:
+        max_connections = env_int(environ, 'DB_MAX_CONNECTIONS', None)
+    if max_connections is None:
+        max_connections = server_max_connections(environ.get('DATABASE_URL')) or FALLBACK_MAX_CONNECTIONS
+    budget = max(max_connections - env_int(environ, 'DB_RESERVED_CONNECTIONS', DEFAULT_RESERVED), 1)
+
+    # Fewer threads before fewer processes: a process is what uses a CPU.
+    workers = max(min(workers, budget), 1)
+    per_worker = budget // workers
+    threads = max(min(threads, per_worker), 1)
+    pool_size = env_int(environ, 'DB_POOL_SIZE', threads)
+    max_overflow = env_int(environ, 'DB_MAX_OVERFLOW',
+                           max(min(threads * OVERFLOW_PER_THREAD, per_worker - pool_size), 0))
+    return {
+        'worker_class': worker_class,
+        'workers': workers,
+        'threads': threads,
+        'timeout': env_int(environ, 'WEB_TIMEOUT', 60),
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'cpus': cpus,
+        'max_connections': max_connections,
+        'budget': budget,
+        'connections': workers * (pool_size + max_overflow),
+    }
+
+
+def export(settings, environ=os.environ):
+    """Hand the pool sizes to db_pool.engine_options through the environment."""
+    environ['DB_POOL_SIZE'] = str(settings['pool_size'])
+    environ['DB_MAX_OVERFLOW'] = str(settings['max_overflow'])
+
+
+def describe(settings):
+    return (f'{settings["workers"]} {settings["worker_class"]} workers x {settings["threads"]} threads, '
+            f'pool {settings["pool_size"]}+{settings["max_overflow"]} per worker, '
+            f'{settings["connections"]} of {settings["budget"]} connections')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Print the web server sizing for this machine and database.')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+    settings = plan()
+    print(json.dumps(settings, indent=2) if args.json else describe(settings))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
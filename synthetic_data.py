@@ -0,0 +1,263 @@
+"""Deterministic synthetic data for testing the app at production size.
+
+Fills all seven tables with COPY. The same seed and scale always produce
+the same rows, so benchmark runs on different machines or commits compare
+like with like. Distributions are skewed the way real traffic is: a few big
+cities hold most users, a few popular caregivers get most appointments, a
+few jobs attract most applications, and recent dates are more common.
+
+Usage:
+    python synthetic_data.py --scale 10k --truncate
+    python synthetic_data.py --users 250000 --seed 7 --truncate
+
+Scales are approximate total row counts across all tables.
+"""
+import argparse
+import csv
+import io
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import text
+
+from bulk_import import ChunkReader
+
+# Users per scale; every user produces about 8 rows across all tables.
+SCALES = {
+    '10k': 1_200,
+    '100k': 12_000,
+    '1m': 120_000,
+    '10m': 1_200_000,
+}
+
+CAREGIVER_SHARE = 0.4
+JOBS_PER_MEMBER = 1.5
+APPLICATIONS_PER_JOB = 4
+APPOINTMENTS_PER_CAREGIVER = 3
+
+CITIES = [
+    ('Almaty', 30), ('Astana', 25), ('Shymkent', 10), ('Atyrau', 6), ('Aktobe', 5),
+    ('Karaganda', 5), ('Uralsk', 4), ('Pavlodar', 4), ('Aktau', 3), ('Kostanay', 3),
+    ('Taraz', 2), ('Talgar', 1), ('Semey', 1), ('Turkestan', 1),
+]
+CAREGIVING_TYPES = [('babysitter', 50), ('elderly care', 30), ('playmate', 20)]
+STATUSES = [('accepted', 60), ('pending', 25), ('declined', 15)]
+GENDERS = [('Female', 70), ('Male', 28), ('Other', 2)]
+GIVEN_NAMES = [
+    'Amir', 'Aisu', 'Aina', 'Arman', 'Azamat', 'Aigerim', 'Dana', 'Dias', 'Erlan', 'Gulnara',
+    'Madina', 'Nurlan', 'Sanzhar', 'Timur', 'Zarina', 'Alina', 'Askar', 'Bota', 'Kairat', 'Saule',
+]
+SURNAMES = [
+    'Amirov', 'Azamatov', 'Kassymov', 'Nurlanova', 'Seitkali', 'Tulegenov', 'Zhaksybekov',
+    'Omarova', 'Bekova', 'Iskakov', 'Mukanov', 'Sadykova', 'Abenov', 'Karimova', 'Utepov',
+]
+STREETS = ['Dostyk', 'Abay', 'Kabanbay Batyr', 'Respublika', 'Mangilik El', 'Turan', 'Satpayev', 'Tole Bi']
+HOUSE_RULES = ['No pets.', 'No smoking.', 'Quiet after 9pm.', 'Shoes off.', 'No guests.', 'Clean up after meals.']
+REQUIREMENTS = [
+    'soft-spoken preferred', 'experience with toddlers', 'first aid certificate', 'medical knowledge',
+    'patient and understanding', 'creative and active', 'music background', 'can cook simple meals',
+    'speaks English', 'driving licence', 'gentle approach', 'sports and fun',
+]
+DEPENDENTS = [
+    '{age} year old son who loves video games', '{age} year old daughter who loves swimming',
+    '{age} year old father with hearing issues', '{age} year old mother, needs medication reminders',
+    'twins, {age} years old, very energetic', '{age} year old grandfather with mobility issues',
+]
+
+
+def _cumulative(weighted):
+    values, totals, running = [], [], 0
+    for value, weight in weighted:
+        running += weight
+        values.append(value)
+        totals.append(running)
+    return values, totals
+
+
+class Generator:
+    """Produces the rows for one dataset; nothing is kept in memory."""
+
+    def __init__(self, users, seed=42, today=date(2025, 12, 1)):
+        self.users = users
+        self.caregivers = int(users * CAREGIVER_SHARE)
+        self.members = users - self.caregivers
+        self.jobs = int(self.members * JOBS_PER_MEMBER)
+        self.seed = seed
+        self.today = today
+        self.cities = _cumulative(CITIES)
+        self.types = _cumulative(CAREGIVING_TYPES)
+        self.statuses = _cumulative(STATUSES)
+        self.genders = _cumulative(GENDERS)
+
+    def rng(self, table):
+        # One independent stream per table, so changing how one table is
+        # generated does not reshuffle all the others.
+        return random.Random(f'{self.seed}:{table}')
+
+    @staticmethod
+    def pick(rng, weighted):
+        values, totals = weighted
+        return rng.choices(values, cum_weights=totals)[0]
+
+    @staticmethod
+    def skewed(rng, n, skew=2.5):
+        """Index in [0, n) biased towards 0 (power law)."""
+        return min(int(n * rng.random() ** skew), n - 1)
+
+    def recent_date(self, rng, days=730):
+        return self.today - timedelta(days=self.skewed(rng, days, 1.6))
+
+    def caregiver_id(self, rng):
+        return 1 + self.skewed(rng, self.caregivers)
+
+    def member_id(self, rng):
+        return self.caregivers + 1 + self.skewed(rng, self.members, 1.4)
+
+    def user_rows(self):
+        rng = self.rng('user')
+        for user_id in range(1, self.users + 1):
+            given = rng.choice(GIVEN_NAMES)
+            surname = rng.choice(SURNAMES)
+            yield (user_id, f'{given.lower()}.{surname.lower()}{user_id}@example.com', given, surname,
+                   self.pick(rng, self.cities), f'+77{rng.randrange(10 ** 8, 10 ** 9)}',
+                   rng.choice(['Experienced', 'New in caregiving', 'Parent', 'Student', 'Retired nurse']),
+                   f'password{user_id}')
+
+    def caregiver_rows(self):
+        rng = self.rng('caregiver')
+        for user_id in range(1, self.caregivers + 1):
+            yield (user_id, f'photo_{user_id}.jpg', self.pick(rng, self.genders), self.pick(rng, self.types),
+                   round(rng.lognormvariate(2.3, 0.3), 2))
+
+    def member_rows(self):
+        rng = self.rng('member')
+        for user_id in range(self.caregivers + 1, self.users + 1):
+            rules = ' '.join(rng.sample(HOUSE_RULES, rng.randint(0, 2))) or None
+            yield (user_id, rules, rng.choice(DEPENDENTS).format(age=rng.randint(2, 90)))
+
+    def address_rows(self):
+        rng = self.rng('address')
+        for user_id in range(self.caregivers + 1, self.users + 1):
+            yield (user_id, str(rng.randint(1, 300)), rng.choice(STREETS), self.pick(rng, self.cities))
+
+    def job_rows(self):
+        rng = self.rng('job')
+        for job_id in range(1, self.jobs + 1):
+            yield (job_id, self.member_id(rng), self.pick(rng, self.types),
+                   ', '.join(rng.sample(REQUIREMENTS, rng.randint(1, 3))), self.recent_date(rng))
+
+    def application_rows(self):
+        rng = self.rng('job_application')
+        for job_id in range(1, self.jobs + 1):
+            # Most jobs get a handful of applicants, a few get many.
+            count = min(int(rng.expovariate(1 / APPLICATIONS_PER_JOB)), self.caregivers)
+            applied = self.recent_date(rng)
+            seen = set()
+            for _ in range(count):
+                caregiver_id = self.caregiver_id(rng)
+                if caregiver_id in seen:
+                    continue
+                seen.add(caregiver_id)
+                yield (caregiver_id, job_id, applied + timedelta(days=rng.randint(0, 14)))
+
+    def appointment_rows(self):
+        rng = self.rng('appointment')
+        # Live bookings per caregiver and start date. A caregiver cannot hold
+        # two overlapping live bookings (migration 27), so a clash is
+        # generated as declined instead.
+        booked = {}
+        for appointment_id in range(1, self.caregivers * APPOINTMENTS_PER_CAREGIVER + 1):
+            caregiver_id, member_id, day = self.caregiver_id(rng), self.member_id(rng), self.recent_date(rng)
+            hour, minute = rng.randint(7, 20), rng.choice(['00', '30'])
+            hours, status = rng.randint(2, 16) / 2, self.pick(rng, self.statuses)
+            if status != 'declined':
+                start = datetime(day.year, day.month, day.day, hour, int(minute))
+                end = start + timedelta(hours=hours)
+                days = booked.setdefault(caregiver_id, {})
+                if any(other_start < end and start < other_end
+                       for offset in (-1, 0, 1)
+                       for other_start, other_end in days.get(day + timedelta(days=offset), ())):
+                    status = 'declined'
+                else:
+                    days.setdefault(day, []).append((start, end))
+            yield (appointment_id, caregiver_id, member_id, day, f'{hour:02d}:{minute}', hours, status)
+
+    def tables(self):
+        """(table, columns, rows, serial column) in foreign-key order."""
+        return [
+            ('"USER"', ['user_id', 'email', 'given_name', 'surname', 'city', 'phone_number',
+                        'profile_description', 'password'], self.user_rows(), 'user_id'),
+            ('caregiver', ['caregiver_user_id', 'photo', 'gender', 'caregiving_type', 'hourly_rate'],
+             self.caregiver_rows(), None),
+            ('member', ['member_user_id', 'house_rules', 'dependent_description'], self.member_rows(), None),
+            ('address', ['member_user_id', 'house_number', 'street', 'town'], self.address_rows(), None),
+            ('job', ['job_id', 'member_user_id', 'required_caregiving_type', 'other_requirements', 'date_posted'],
+             self.job_rows(), 'job_id'),
+            ('job_application', ['caregiver_user_id', 'job_id', 'date_applied'], self.application_rows(), None),
+            ('appointment', ['appointment_id', 'caregiver_user_id', 'member_user_id', 'appointment_date',
+                             'appointment_time', 'work_hours', 'status'], self.appointment_rows(), 'appointment_id'),
+        ]
+
+
+def _csv_chunks(rows, chunk_size=1 << 16):
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    for row in rows:
+        writer.writerow(row)
+        if out.tell() >= chunk_size:
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+    yield out.getvalue()
+
+
+def load(engine, generator, truncate=False, log=print):
+    """COPY every table of ``generator`` into the database. Returns row counts."""
+    counts = {}
+    with engine.begin() as connection:
+        if truncate:
+            connection.execute(text(
+                'TRUNCATE "USER", caregiver, member, address, job, job_application, appointment '
+                'RESTART IDENTITY CASCADE'
+            ))
+        else:
+            existing = connection.execute(text('SELECT count(*) FROM "USER"')).scalar()
+            if existing:
+                raise SystemExit('Database is not empty; pass --truncate to replace its data')
+        cursor = connection.connection.driver_connection.cursor()
+        for table, columns, rows, serial in generator.tables():
+            started = time.perf_counter()
+            cursor.copy_expert(f'COPY {table} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)',
+                               ChunkReader(_csv_chunks(rows)))
+            counts[table.strip('"')] = cursor.rowcount
+            if serial:
+                connection.execute(text(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', '{serial}'), "
+                    f'(SELECT COALESCE(max({serial}), 1) FROM {table}))'
+                ))
+            log(f'{table}: {cursor.rowcount} rows in {time.perf_counter() - started:.1f}s')
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        connection.execute(text('ANALYZE'))
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fill the database with deterministic synthetic data.')
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument('--scale', choices=sorted(SCALES), default='10k')
+    size.add_argument('--users', type=int, help='exact number of users instead of a preset scale')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--truncate', action='store_true', help='delete all existing data first')
+    args = parser.parse_args(argv)
+
+    from migrations import get_engine
+    generator = Generator(args.users or SCALES[args.scale], seed=args.seed)
+    counts = load(get_engine(), generator, truncate=args.truncate)
+    print(f'Loaded {sum(counts.values())} rows (seed {args.seed})')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,514 @@
+"""Background tasks: a durable queue in Postgres and a local worker.
+
+Long operations such as schema setup, bulk imports and report rebuilds
+should not run inside a web request, where they hold a gunicorn worker
+and can hit its timeout. The web app calls ``enqueue`` instead. That
+inserts a row into ``tasks`` (migration 31) and returns at once; pages
+and ``/api/tasks/<id>`` poll the row for status and progress.
+
+``python tasks.py worker`` claims queued tasks one at a time with
+``FOR UPDATE SKIP LOCKED``, so several workers can share the queue. While
+a task runs, a heartbeat thread writes its progress every
+``HEARTBEAT_SECONDS`` and checks for a cancel request. A cancelled task is
+stopped at its next progress check. Its running statement is cancelled with
+``pg_cancel_backend`` and a child process is terminated, and either way its
+transaction rolls back. If a worker dies, its task's heartbeat goes stale
+and the next poll puts the task back in the queue, up to ``MAX_ATTEMPTS``
+runs in all. Workers also queue the tasks in ``SCHEDULE`` when they are
+due, such as the daily partition maintenance.
+
+Usage:
+    python tasks.py worker [--poll 1] [--once]
+    python tasks.py enqueue migrate
+    python tasks.py enqueue bulk_import table=users --file users.csv
+    python tasks.py list
+    python tasks.py cancel 42
+"""
+import argparse
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+from sqlalchemy import text
+
+import applicant_counts
+import bulk_edit
+import bulk_import
+import matching
+import migrations
+import partitions
+import purge
+
+POLL_SECONDS = 1.0
+HEARTBEAT_SECONDS = 2.0
+# A running task whose heartbeat is older than this lost its worker.
+STALE_SECONDS = 60
+MAX_ATTEMPTS = 3
+FINISHED = ('succeeded', 'failed', 'cancelled')
+# Tasks the worker queues itself: kind -> seconds between runs.
+SCHEDULE = {'maintain_partitions': 24 * 3600}
+SCHEDULE_CHECK_SECONDS = 60
+
+_INSERT = text("""
+    INSERT INTO tasks (kind, params) VALUES (:kind, CAST(:params AS jsonb)) RETURNING task_id
+""")
+_INSERT_PAYLOAD = text('INSERT INTO task_payloads (task_id, data) VALUES (:task_id, :data)')
+
+_CLAIM = text("""
+    UPDATE tasks SET status = 'running', attempts = attempts + 1, worker = :worker,
+        started_at = now(), heartbeat_at = now(), cancel_requested = false, error = NULL
+    WHERE task_id = (
+        SELECT task_id FROM tasks WHERE status = 'queued' ORDER BY task_id LIMIT 1 FOR UPDATE SKIP LOCKED)
+    RETURNING task_id, kind, params
+""")
+
+_REQUEUE_STALE = text("""
+    UPDATE tasks SET
+        status = CASE WHEN attempts < :max_attempts THEN 'queued' ELSE 'failed' END,
+        error = 'worker ' || coalesce(worker, '?') || ' stopped responding',
+        finished_at = CASE WHEN attempts < :max_attempts THEN NULL ELSE now() END
+    WHERE status = 'running' AND heartbeat_at < now() - make_interval(secs => :stale)
+    RETURNING task_id, status
+""")
+
+_HEARTBEAT = text("""
+    UPDATE tasks SET heartbeat_at = now(), done = :done, total = :total, message = :message
+    WHERE task_id = :task_id
+    RETURNING cancel_requested
+""")
+
+_FINISH = text("""
+    UPDATE tasks SET status = :status, result = CAST(:result AS jsonb), error = :error,
+        done = :done, total = :total, message = :message, heartbeat_at = now(), finished_at = now()
+    WHERE task_id = :task_id
+""")
+
+_CANCEL = text("""
+    UPDATE tasks SET cancel_requested = true,
+        status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END,
+        finished_at = CASE WHEN status = 'queued' THEN now() END
+    WHERE task_id = :task_id AND status IN ('queued', 'running')
+    RETURNING status
+""")
+
+# Queues a scheduled task unless one is waiting, running or finished within
+# its interval. The lock keeps workers checking at once from both queueing it.
+_SCHEDULE = text("""
+    INSERT INTO tasks (kind, params)
+    SELECT :kind, '{}' FROM (SELECT pg_advisory_xact_lock(hashtext('tasks.schedule'))) locked
+    WHERE NOT EXISTS (
+        SELECT 1 FROM tasks WHERE kind = :kind
+        AND (status IN ('queued', 'running') OR created_at > now() - make_interval(secs => :every)))
+    RETURNING task_id
+""")
+
+TASKS = {}
+
+
+class TaskError(Exception):
+    pass
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+def task(name):
+    """Register ``func(context, **params)`` as the task kind ``name``.
+
+    The first line of its docstring is the title shown in the app.
+    """
+    def register(func):
+        TASKS[name] = func
+        return func
+    return register
+
+
+def title(kind):
+    func = TASKS.get(kind)
+    return func.__doc__.strip().splitlines()[0] if func and func.__doc__ else kind
+
+
+class TaskContext:
+    """What a running task uses to report progress and notice cancellation."""
+
+    def __init__(self, engine, task_id):
+        self.engine = engine
+        self.task_id = task_id
+        self.done = None
+        self.total = None
+        self.message = None
+        self.cancel_requested = False
+        self.process = None
+        self._source = None
+        self._pids = set()
+        self._stopped = threading.Event()
+
+    def progress(self, done=None, total=None, message=None):
+        """Record progress; raises TaskCancelled once a cancel is requested."""
+        if done is not None:
+            self.done = done
+            self._source = None
+        if total is not None:
+            self.total = total
+        if message is not None:
+            self.message = message
+        if self.cancel_requested:
+            raise TaskCancelled()
+
+    def log(self, message):
+        self.progress(message=message)
+
+    def track(self, source, total):
+        """Report ``source()`` as done out of ``total`` on every heartbeat.
+
+        Until the next ``progress(done=...)``, which replaces it.
+        """
+        self._source = source
+        self.total = total
+
+    @contextmanager
+    def transaction(self):
+        """``engine.begin()`` whose running statement a cancel request interrupts."""
+        with self.engine.begin() as connection:
+            pid = connection.execute(text('SELECT pg_backend_pid()')).scalar()
+            self._pids.add(pid)
+            try:
+                yield connection
+            finally:
+                self._pids.discard(pid)
+
+    def payload(self):
+        with self.engine.connect() as connection:
+            data = connection.execute(
+                text('SELECT data FROM task_payloads WHERE task_id = :task_id'), {'task_id': self.task_id}
+            ).scalar()
+        if data is None:
+            raise TaskError('the uploaded file is missing')
+        return bytes(data)
+
+    def beat(self):
+        if self._source is not None:
+            self.done = self._source()
+        with self.engine.begin() as connection:
+            cancel = connection.execute(_HEARTBEAT, {
+                'task_id': self.task_id, 'done': self.done, 'total': self.total, 'message': self.message,
+            }).scalar()
+            if cancel and not self.cancel_requested:
+                self.cancel_requested = True
+                for pid in list(self._pids):
+                    connection.execute(text('SELECT pg_cancel_backend(:pid)'), {'pid': pid})
+                if self.process is not None:
+                    self.process.terminate()
+
+    def heartbeat(self):
+        while not self._stopped.wait(HEARTBEAT_SECONDS):
+            try:
+                self.beat()
+            except Exception:
+                # The next beat retries; a run of failures shows up as a
+                # stale heartbeat.
+                traceback.print_exc()
+
+    def stop(self):
+        self._stopped.set()
+
+
+def enqueue(connection, kind, params=None, payload=None):
+    """Queue a task and return its id. ``payload`` is an optional file body."""
+    if kind not in TASKS:
+        raise ValueError(f'Unknown task {kind!r}; expected one of {", ".join(sorted(TASKS))}')
+    task_id = connection.execute(_INSERT, {'kind': kind, 'params': json.dumps(params or {})}).scalar()
+    if payload is not None:
+        connection.execute(_INSERT_PAYLOAD, {'task_id': task_id, 'data': payload})
+    return task_id
+
+
+def cancel(connection, task_id):
+    """Request cancellation. Returns the task's status, or None if it already finished."""
+    return connection.execute(_CANCEL, {'task_id': task_id}).scalar()
+
+
+def requeue_stale(engine):
+    with engine.begin() as connection:
+        return connection.execute(_REQUEUE_STALE, {'max_attempts': MAX_ATTEMPTS, 'stale': STALE_SECONDS}).all()
+
+
+def schedule(engine):
+    """Queue the scheduled tasks that are due. Returns (kind, task_id) pairs."""
+    queued = []
+    with engine.begin() as connection:
+        for kind, every in SCHEDULE.items():
+            task_id = connection.execute(_SCHEDULE, {'kind': kind, 'every': every}).scalar()
+            if task_id is not None:
+                queued.append((kind, task_id))
+    return queued
+
+
+def claim(engine, worker):
+    with engine.begin() as connection:
+        return connection.execute(_CLAIM, {'worker': worker}).first()
+
+
+def run(engine, claimed, log=print):
+    """Run one claimed task and record how it ended."""
+    context = TaskContext(engine, claimed.task_id)
+    heartbeat = threading.Thread(target=context.heartbeat, daemon=True)
+    heartbeat.start()
+    result = error = None
+    log(f'task {claimed.task_id}: {claimed.kind} started')
+    try:
+        func = TASKS.get(claimed.kind)
+        if func is None:
+            raise TaskError(f'unknown task {claimed.kind!r}')
+        result = func(context, **claimed.params)
+        status = 'succeeded'
+    except Exception as e:
+        status = 'cancelled' if context.cancel_requested else 'failed'
+        if status == 'failed':
+            error = str(e) or type(e).__name__
+            if not isinstance(e, TaskError):
+                traceback.print_exc()
+    finally:
+        context.stop()
+        heartbeat.join()
+    with engine.begin() as connection:
+        connection.execute(_FINISH, {
+            'task_id': claimed.task_id, 'status': status, 'result': None if result is None else json.dumps(result, default=str),
+            'error': error, 'done': context.done, 'total': context.total, 'message': context.message,
+        })
+        connection.execute(text('DELETE FROM task_payloads WHERE task_id = :task_id'),
+                           {'task_id': claimed.task_id})
+    log(f'task {claimed.task_id}: {status}' + (f' ({error})' if error else ''))
+    return status
+
+
+def work(engine, poll=POLL_SECONDS, once=False, log=print):
+    """Run queued tasks until stopped; with ``once``, until the queue is empty."""
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    scheduled_at = None
+    while True:
+        for row in requeue_stale(engine):
+            log(f'task {row.task_id}: worker lost, now {row.status}')
+        if scheduled_at is None or time.monotonic() - scheduled_at >= SCHEDULE_CHECK_SECONDS:
+            scheduled_at = time.monotonic()
+            for kind, task_id in schedule(engine):
+                log(f'task {task_id}: {kind} scheduled')
+        claimed = claim(engine, worker)
+        if claimed is not None:
+            run(engine, claimed, log)
+        elif once:
+            return
+        else:
+            time.sleep(poll)
+
+
+def describe(row):
+    """JSON-ready view of a task row or model."""
+    percent = None
+    if row.total and row.done is not None:
+        percent = round(min(row.done / row.total, 1) * 100, 1)
+    return {
+        'task_id': row.task_id,
+        'kind': row.kind,
+        'title': title(row.kind),
+        'params': row.params,
+        'status': row.status,
+        'done': row.done,
+        'total': row.total,
+        'percent': percent,
+        'message': row.message,
+        'result': row.result,
+        'error': row.error,
+        'cancel_requested': row.cancel_requested,
+        'attempts': row.attempts,
+        'created_at': row.created_at.isoformat() if row.created_at else None,
+        'started_at': row.started_at.isoformat() if row.started_at else None,
+        'finished_at': row.finished_at.isoformat() if row.finished_at else None,
+    }
+
+
+@task('migrate')
+def migrate(context):
+    """Apply pending schema migrations"""
+    with context.engine.connect() as connection:
+        tracked = connection.execute(text("SELECT to_regclass('schema_migrations')")).scalar()
+        pending = migrations.pending_migrations(connection) if tracked else migrations.MIGRATIONS
+    context.progress(0, len(pending))
+
+    def log(message):
+        context.progress(done=(context.done or 0) + message.startswith('Applying'), message=message)
+
+    # Stops between migrations when cancelled; each one is atomic or idempotent.
+    return {'applied': migrations.upgrade(context.engine, log=log)}
+
+
+@task('init_db')
+def init_db(context):
+    """Reset to the assignment data (drops and recreates every table, then migrates)"""
+    context.process = subprocess.Popen(
+        [sys.executable, 'queries.py'], cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+    )
+    tail = []
+    for line in context.process.stdout:
+        line = line.rstrip()
+        if line:
+            tail = (tail + [line])[-50:]
+            context.log(line[:500])
+    if context.process.wait() != 0:
+        raise TaskError(f'queries.py exited with status {context.process.returncode}: {tail[-1] if tail else ""}')
+    # queries.py recreates the tables as plain ones, without the triggers,
+    # partitions and derived tables; every migration has to run again.
+    with context.engine.begin() as connection:
+        connection.execute(text('DROP TABLE IF EXISTS schema_migrations'))
+    return {'output': tail, 'applied': migrations.upgrade(context.engine, log=context.log)}
+
+
+@task('bulk_import')
+def import_upload(context, table, format='csv', on_conflict='skip'):
+    """Bulk import an uploaded file"""
+    data = context.payload()
+    raw = io.BytesIO(data)
+    context.track(raw.tell, len(data))
+    with context.transaction() as connection:
+        result = bulk_import.import_stream(
+            connection, table, io.TextIOWrapper(raw, encoding='utf-8-sig', newline=''), format, on_conflict
+        )
+    context.progress(len(data))
+    return result.as_dict()
+
+
+@task('bulk_edit')
+def bulk_edit_task(context, target, action, where=None, set=None):
+    """Bulk edit filtered rows"""
+    try:
+        edit = bulk_edit.Edit(target, action, where, set)
+        context.log(f'{action} {target}')
+        with context.transaction() as connection:
+            return bulk_edit.run(connection, edit)
+    except bulk_edit.BulkEditError as e:
+        raise TaskError(str(e))
+
+
+@task('purge_account')
+def purge_account(context, kind, id):
+    """Delete a large account in batches"""
+    context.log(f'purging {kind} {id}')
+    # Each batch commits on its own; a cancelled purge can be run again.
+    result = purge.purge(context.engine, kind, id, progress=context.progress)
+    if not result['found']:
+        raise TaskError(f'{kind} {id} not found')
+    return result
+
+
+@task('rebuild_reports')
+def rebuild_reports(context):
+    """Rebuild the earnings and appointment cost reports"""
+    statements = migrations.REPORTS_REBUILD_SQL
+    with context.transaction() as connection:
+        # Holds off appointment and rate changes, whose triggers would
+        # otherwise race the rebuild, but lets readers through.
+        connection.execute(text('LOCK TABLE appointment, caregiver IN SHARE ROW EXCLUSIVE MODE'))
+        for done, statement in enumerate(statements):
+            context.progress(done, len(statements))
+            connection.execute(text(statement))
+        context.progress(len(statements))
+        rows = connection.execute(text('SELECT count(*) FROM appointment_costs')).scalar()
+    return {'appointment_costs': rows}
+
+
+@task('repair_applicant_counts')
+def repair_applicant_counts(context):
+    """Recount applicants of jobs whose count drifted"""
+    with context.transaction() as connection:
+        return {'repaired': applicant_counts.repair(connection)}
+
+
+@task('refresh_matches')
+def refresh_matches(context, rebuild=False):
+    """Recompute queued caregiver match lists"""
+    if rebuild:
+        with context.transaction() as connection:
+            matching.queue_all(connection)
+    with context.engine.connect() as connection:
+        context.progress(0, sum(matching.queue_status(connection).values()))
+
+    def log(message):
+        context.progress(done=context.done + int(message.split()[0]), message=message)
+
+    # Each batch commits on its own, so a cancel keeps the finished ones.
+    return {'jobs': matching.refresh(context.engine, log=log)}
+
+
+@task('maintain_partitions')
+def maintain_partitions(context):
+    """Create upcoming monthly partitions and archive expired months"""
+    # Each archive batch commits on its own; the next run finishes a cancelled one.
+    return partitions.maintain(context.engine, log=context.log)
+
+
+def _params(pairs):
+    params = {}
+    for pair in pairs:
+        key, sep, value = pair.partition('=')
+        if not sep:
+            raise SystemExit(f'expected key=value, got {pair!r}')
+        try:
+            params[key] = json.loads(value)
+        except ValueError:
+            params[key] = value
+    return params
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run or manage background tasks.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    worker = commands.add_parser('worker', help='run queued tasks')
+    worker.add_argument('--poll', type=float, default=POLL_SECONDS, help='seconds between queue polls')
+    worker.add_argument('--once', action='store_true', help='exit when the queue is empty')
+    add = commands.add_parser('enqueue', help='queue a task')
+    add.add_argument('kind', choices=sorted(TASKS))
+    add.add_argument('params', nargs='*', metavar='key=value')
+    add.add_argument('--file', help='payload file, e.g. for bulk_import')
+    commands.add_parser('list', help='show recent tasks')
+    stop = commands.add_parser('cancel', help='cancel a queued or running task')
+    stop.add_argument('task_id', type=int)
+    args = parser.parse_args(argv)
+
+    engine = migrations.get_engine()
+    if args.command == 'worker':
+        work(engine, args.poll, args.once)
+        return 0
+    if args.command == 'enqueue':
+        payload = None
+        if args.file:
+            with open(args.file, 'rb') as f:
+                payload = f.read()
+        with engine.begin() as connection:
+            task_id = enqueue(connection, args.kind, _params(args.params), payload)
+        print(f'task {task_id} queued')
+        return 0
+    if args.command == 'cancel':
+        with engine.begin() as connection:
+            status = cancel(connection, args.task_id)
+        print(f'task {args.task_id}: ' + ('cancel requested' if status == 'running' else status or 'already finished'))
+        return 0
+    with engine.connect() as connection:
+        rows = connection.execute(text('SELECT * FROM tasks ORDER BY task_id DESC LIMIT 20')).all()
+    for row in rows:
+        info = describe(row)
+        progress = f' {info["percent"]}%' if info['percent'] is not None and row.status == 'running' else ''
+        print(f'{row.task_id:>6} {row.status:9}{progress} {row.kind} {row.error or row.message or ""}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
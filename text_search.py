@@ -0,0 +1,64 @@
+"""Ranked full-text search with typo correction.
+
+``job``, ``member`` and ``"USER"`` carry a stored ``search_vector``
+(tsvector) column that triggers keep current and a GIN index covers
+(migrations 14-22). Matching and ranking read it directly, so nothing is
+re-parsed per row. Stemming makes ``pets`` find "No pets." and
+``toddlers`` find "experience with toddlers".
+
+Typos are fixed before searching: each query word missing from
+``search_words`` (every word seen in the searched table) is replaced by the
+most similar word there, found with a pg_trgm GiST index. Stop words and
+words that stem the same as their nearest neighbour (``toddler`` vs
+"toddlers") are left alone. The corrected query is returned so pages can
+say what was actually searched for.
+"""
+import re
+
+from sqlalchemy import Float, Text, cast, func, literal_column, text
+from sqlalchemy.dialects.postgresql import TSVECTOR
+
+CONFIG = literal_column("'english'::regconfig")
+# Column type of search_vector; plain text keeps a quick sqlite run working.
+VECTOR = TSVECTOR().with_variant(Text(), 'sqlite')
+WORD = re.compile(r'[^\W\d_]{3,}(?:-[^\W\d_]+)*')
+
+_NEAREST_WORDS = text("""
+    SELECT token, nearest.word
+    FROM unnest(CAST(:tokens AS text[])) AS token
+    CROSS JOIN LATERAL (
+        SELECT word FROM search_words
+        WHERE source = :source AND word % token
+        ORDER BY word <-> token
+        LIMIT 1
+    ) AS nearest
+    WHERE length(to_tsvector('english', token)) > 0
+      AND to_tsvector('english', nearest.word) <> to_tsvector('english', token)
+""")
+
+
+def correct(session, q, source):
+    """``q`` with every unknown word replaced by its nearest word in ``source``."""
+    tokens = sorted({match.group().lower() for match in WORD.finditer(q)})
+    if not tokens:
+        return q
+    rows = session.execute(_NEAREST_WORDS, {'tokens': tokens, 'source': source})
+    fixes = {row.token: row.word for row in rows}
+    if not fixes:
+        return q
+    return WORD.sub(lambda match: fixes.get(match.group().lower(), match.group()), q)
+
+
+def tsquery(q):
+    """``q`` in web-search syntax: quoted phrases, ``or`` and ``-word``."""
+    return func.websearch_to_tsquery(CONFIG, q)
+
+
+def condition(q, vector):
+    return vector.op('@@')(tsquery(q))
+
+
+def rank(q, vectors):
+    """Relevance of a row: ``ts_rank`` summed over ``vectors``."""
+    terms = [func.coalesce(func.ts_rank(vector, tsquery(q), type_=Float), 0) for vector in vectors]
+    return cast(sum(terms[1:], terms[0]), Float).label('rank')